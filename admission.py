@@ -0,0 +1,68 @@
+'''
+Admission control of the server. Instead of refusing users past a small fixed count, the server
+refuses new joins while it is overloaded and tells the client when to retry.
+Overload is measured, not guessed: a probe timer checks how late the engine runs its timers,
+which grows with the receive queue, how much of a core the process uses and how many
+packets wait to be sent.
+'''
+import math
+import time
+
+PROBE_INTERVAL = 0.5
+# a smoothed timer lateness above MAX_LOOP_LAG means the engine cannot keep up with its socket
+MAX_LOOP_LAG = 0.05
+# share of one core used by the process
+MAX_CPU = 0.9
+# packets waiting to be sent
+MAX_QUEUE_DEPTH = 1024
+# smoothing factor of the measurements
+GAIN = 0.3
+MIN_RETRY_AFTER = 1.0
+MAX_RETRY_AFTER = 30.0
+
+
+class AdmissionControl:
+    '''
+    Backpressure measurements of one server
+    '''
+    def __init__(self, server):
+        self.server = server
+        self.lag = 0.0
+        self.cpu = 0.0
+        self.queue_depth = 0.0
+        self.wall = time.monotonic()
+        self.cpu_time = time.process_time()
+        self.timer = None
+
+    def start(self):
+        '''
+        Starts the probe on the running engine
+        '''
+        self.wall = time.monotonic()
+        self.cpu_time = time.process_time()
+        self.timer = self.server.call_later(PROBE_INTERVAL, self.probe, self.wall + PROBE_INTERVAL)
+
+    def stop(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+    def probe(self, due):
+        now = time.monotonic()
+        cpu_time = time.process_time()
+        self.lag += GAIN * (max(now - due, 0.0) - self.lag)
+        if now > self.wall:
+            self.cpu += GAIN * ((cpu_time - self.cpu_time) / (now - self.wall) - self.cpu)
+        self.wall, self.cpu_time = now, cpu_time
+        self.queue_depth += GAIN * (self.server.queue_depth() - self.queue_depth)
+        self.timer = self.server.call_later(PROBE_INTERVAL, self.probe, now + PROBE_INTERVAL)
+
+    def overloaded(self):
+        return self.lag > MAX_LOOP_LAG or self.cpu > MAX_CPU or self.queue_depth > MAX_QUEUE_DEPTH
+
+    def retry_after(self):
+        '''
+        Seconds a refused client should wait, longer the more the server is overloaded
+        '''
+        load = max(self.lag / MAX_LOOP_LAG, self.cpu / MAX_CPU, self.queue_depth / MAX_QUEUE_DEPTH)
+        return min(MIN_RETRY_AFTER * math.ceil(max(load, 1.0)), MAX_RETRY_AFTER)
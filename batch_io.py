@@ -0,0 +1,256 @@
+'''
+Batched datagram I/O.
+BatchReceiver drains every pending datagram of a socket into preallocated buffers and
+BatchSender flushes a list of packets at once. On Linux both use recvmmsg/sendmmsg through ctypes,
+one system call per batch, elsewhere they fall back to one recvfrom_into/sendto per packet.
+'''
+import sys
+import errno
+import socket
+import struct
+import ctypes
+import ctypes.util
+
+BATCH_SIZE = 64
+# larger than the util.CHUNK_SIZE packets of this application, bigger messages are sent in fragments
+BUFFER_SIZE = 2048
+MSG_WAITFORONE = 0x10000
+MSG_DONTWAIT = getattr(socket, "MSG_DONTWAIT", 0)
+SOCKADDR_SIZE = 128
+
+
+class iovec(ctypes.Structure):
+    _fields_ = [("iov_base", ctypes.c_void_p),
+                ("iov_len", ctypes.c_size_t)]
+
+
+class msghdr(ctypes.Structure):
+    _fields_ = [("msg_name", ctypes.c_void_p),
+                ("msg_namelen", ctypes.c_uint32),
+                ("msg_iov", ctypes.POINTER(iovec)),
+                ("msg_iovlen", ctypes.c_size_t),
+                ("msg_control", ctypes.c_void_p),
+                ("msg_controllen", ctypes.c_size_t),
+                ("msg_flags", ctypes.c_int)]
+
+
+class mmsghdr(ctypes.Structure):
+    _fields_ = [("msg_hdr", msghdr),
+                ("msg_len", ctypes.c_uint)]
+
+
+def _load_mmsg():
+    if not sys.platform.startswith("linux"):
+        return None, None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        recvmmsg, sendmmsg = libc.recvmmsg, libc.sendmmsg
+    except (OSError, AttributeError):
+        return None, None
+    recvmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(mmsghdr), ctypes.c_uint, ctypes.c_int, ctypes.c_void_p]
+    recvmmsg.restype = ctypes.c_int
+    sendmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(mmsghdr), ctypes.c_uint, ctypes.c_int]
+    sendmmsg.restype = ctypes.c_int
+    return recvmmsg, sendmmsg
+
+
+_recvmmsg, _sendmmsg = _load_mmsg()
+
+
+def decode_sockaddr(raw):
+    '''
+    Converts a raw sockaddr into the address tuple returned by socket.recvfrom
+    '''
+    family = struct.unpack_from("=H", raw, 0)[0]
+    if family == socket.AF_INET:
+        port = struct.unpack_from("!H", raw, 2)[0]
+        return socket.inet_ntop(socket.AF_INET, raw[4:8]), port
+    if family == socket.AF_INET6:
+        port, flowinfo = struct.unpack_from("!HI", raw, 2)
+        scope_id = struct.unpack_from("=I", raw, 24)[0]
+        return socket.inet_ntop(socket.AF_INET6, raw[8:24]), port, flowinfo, scope_id
+    raise OSError(errno.EAFNOSUPPORT, "unsupported address family %d" % family)
+
+
+def encode_sockaddr(addr):
+    '''
+    Converts a numeric address tuple into a raw sockaddr, returns None if it is not numeric
+    '''
+    try:
+        if len(addr) == 2:
+            raw = bytearray(16)
+            struct.pack_into("=H", raw, 0, socket.AF_INET)
+            struct.pack_into("!H4s", raw, 2, addr[1], socket.inet_pton(socket.AF_INET, addr[0]))
+        else:
+            raw = bytearray(28)
+            struct.pack_into("=H", raw, 0, socket.AF_INET6)
+            struct.pack_into("!HI16s", raw, 2, addr[1], addr[2], socket.inet_pton(socket.AF_INET6, addr[0]))
+            struct.pack_into("=I", raw, 24, addr[3])
+    except (OSError, IndexError, TypeError, struct.error):
+        return None
+    return bytes(raw)
+
+
+def _raise_errno():
+    code = ctypes.get_errno()
+    raise OSError(code, errno.errorcode.get(code, "errno %d" % code))
+
+
+class BatchReceiver:
+    '''
+    Receives up to batch_size datagrams per call into buffers allocated once.
+    The returned memoryviews point into those buffers and are valid until the next receive().
+    '''
+    def __init__(self, sock, batch_size=BATCH_SIZE, buffer_size=BUFFER_SIZE):
+        self.sock = sock
+        self.batch_size = batch_size
+        self.buffers = [bytearray(buffer_size) for _ in range(batch_size)]
+        self.views = [memoryview(buf) for buf in self.buffers]
+        if _recvmmsg is not None:
+            self.names = (ctypes.c_char * (SOCKADDR_SIZE * batch_size))()
+            self.iovecs = (iovec * batch_size)()
+            self.headers = (mmsghdr * batch_size)()
+            for i, buf in enumerate(self.buffers):
+                self.iovecs[i].iov_base = ctypes.addressof((ctypes.c_char * buffer_size).from_buffer(buf))
+                self.iovecs[i].iov_len = buffer_size
+                header = self.headers[i].msg_hdr
+                header.msg_iov = ctypes.pointer(self.iovecs[i])
+                header.msg_iovlen = 1
+                header.msg_name = ctypes.addressof(self.names) + i * SOCKADDR_SIZE
+
+    def receive(self, wait=True):
+        '''
+        Returns a list of (data, addr) with every datagram already queued on the socket.
+        With wait=True blocks until at least one datagram arrives.
+        '''
+        if _recvmmsg is not None:
+            return self._receive_mmsg(wait)
+        return self._receive_loop(wait)
+
+    def _receive_mmsg(self, wait):
+        flags = MSG_WAITFORONE if wait else MSG_DONTWAIT
+        for i in range(self.batch_size):
+            self.headers[i].msg_hdr.msg_namelen = SOCKADDR_SIZE
+        while True:
+            count = _recvmmsg(self.sock.fileno(), self.headers, self.batch_size, flags, None)
+            if count >= 0:
+                break
+            code = ctypes.get_errno()
+            if code == errno.EINTR:
+                continue
+            if code in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return []
+            _raise_errno()
+        names = memoryview(self.names).cast("B")
+        received = []
+        for i in range(count):
+            name = names[i * SOCKADDR_SIZE:(i + 1) * SOCKADDR_SIZE]
+            received.append((self.views[i][:self.headers[i].msg_len], decode_sockaddr(name)))
+        return received
+
+    def _receive_loop(self, wait):
+        received = []
+        for i in range(self.batch_size):
+            try:
+                if i == 0 and wait:
+                    nbytes, addr = self.sock.recvfrom_into(self.buffers[i])
+                else:
+                    nbytes, addr = self.sock.recvfrom_into(self.buffers[i], 0, MSG_DONTWAIT)
+            except (BlockingIOError, InterruptedError):
+                break
+            received.append((self.views[i][:nbytes], addr))
+            if not MSG_DONTWAIT and self.sock.getblocking():
+                # without MSG_DONTWAIT a second read could block
+                break
+        return received
+
+
+class BatchSender:
+    '''
+    Sends a list of (packet, addr) with as few system calls as possible
+    '''
+    def __init__(self, sock, batch_size=BATCH_SIZE):
+        self.sock = sock
+        self.batch_size = batch_size
+        self.sockaddrs = {}
+        if _sendmmsg is not None:
+            self.iovecs = (iovec * batch_size)()
+            self.headers = (mmsghdr * batch_size)()
+            for i in range(batch_size):
+                self.headers[i].msg_hdr.msg_iov = ctypes.pointer(self.iovecs[i])
+                self.headers[i].msg_hdr.msg_iovlen = 1
+
+    def send(self, packets):
+        '''
+        Sends packets in order. Returns how many were handled before the socket buffer filled up.
+        A packet the kernel refuses is dropped like a lost datagram.
+        '''
+        sent = 0
+        while sent < len(packets):
+            try:
+                if _sendmmsg is not None:
+                    count = self._send_mmsg(packets, sent)
+                else:
+                    count = self._send_loop(packets, sent)
+            except (BlockingIOError, InterruptedError):
+                break
+            except OSError:
+                count = 1
+            if count == 0:
+                break
+            sent += count
+        return sent
+
+    def _sockaddr(self, addr):
+        name = self.sockaddrs.get(addr)
+        if name is None:
+            raw = encode_sockaddr(addr)
+            if raw is None:
+                return None
+            if len(self.sockaddrs) >= 4096:
+                self.sockaddrs.clear()
+            name = self.sockaddrs[addr] = ctypes.create_string_buffer(raw, len(raw))
+        return name
+
+    def _send_mmsg(self, packets, start):
+        keep = []
+        count = 0
+        for packet, addr in packets[start:start + self.batch_size]:
+            name = self._sockaddr(addr)
+            if name is None:
+                break
+            data = ctypes.c_char_p(bytes(packet))
+            keep.append(data)
+            self.iovecs[count].iov_base = ctypes.cast(data, ctypes.c_void_p).value
+            self.iovecs[count].iov_len = len(packet)
+            header = self.headers[count].msg_hdr
+            header.msg_name = ctypes.addressof(name)
+            header.msg_namelen = len(name)
+            count += 1
+        if count == 0:
+            # a hostname instead of a numeric address, let the socket module resolve it
+            return self._send_loop(packets, start, 1)
+        while True:
+            result = _sendmmsg(self.sock.fileno(), self.headers, count, MSG_DONTWAIT)
+            if result >= 0:
+                return result
+            code = ctypes.get_errno()
+            if code == errno.EINTR:
+                continue
+            if code in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return 0
+            _raise_errno()
+
+    def _send_loop(self, packets, start, limit=None):
+        count = 0
+        for packet, addr in packets[start:start + (limit or self.batch_size)]:
+            try:
+                self.sock.sendto(packet, addr)
+            except (BlockingIOError, InterruptedError):
+                break
+            except OSError:
+                if count == 0:
+                    raise
+                break
+            count += 1
+        return count
@@ -0,0 +1,140 @@
+'''
+Benchmark of the session capacity of the server.
+Starts a server for every scale, joins that many users from their own UDP sockets and reports
+the join latency (join packet to its ACK), the joins refused as busy and the memory per session.
+'''
+import os
+import sys
+import time
+import getopt
+import socket
+import selectors
+import subprocess
+import util
+import batch_io
+
+SERVER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "server.py")
+# a join without ACK after RETRY_TIMEOUT is sent again, at most MAX_RETRIES times
+RETRY_TIMEOUT = 1.0
+MAX_RETRIES = 5
+
+
+def rss_kb(pid):
+    '''
+    Resident memory of process pid in KB, None where /proc is not available
+    '''
+    try:
+        with open("/proc/%d/status" % pid) as status:
+            for line in status:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def join_users(port, count, concurrency):
+    '''
+    Joins count users, concurrency of them in flight at a time.
+    Returns the join latencies in seconds and the number of joins answered with ERR_SERVER_BUSY.
+    '''
+    selector = selectors.DefaultSelector()
+    latencies = []
+    busy = 0
+    launched = 0
+    while launched < count or selector.get_map():
+        while launched < count and len(selector.get_map()) < concurrency:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.setblocking(False)
+            join_message = util.make_message("join", 1, "user%d" % launched)
+            join_packet = util.make_packet("data", 0, join_message).encode()
+            sock.sendto(join_packet, ("localhost", port))
+            # send time, answered busy, packet, last send time, retries
+            now = time.perf_counter()
+            selector.register(sock, selectors.EVENT_READ, [now, False, join_packet, now, 0])
+            launched += 1
+        events = selector.select(timeout=RETRY_TIMEOUT / 4)
+        now = time.perf_counter()
+        for key in list(selector.get_map().values()):
+            state = key.data
+            if now - state[3] >= RETRY_TIMEOUT:
+                # lost join or ACK
+                if state[4] == MAX_RETRIES:
+                    raise RuntimeError("the server stopped answering after %d joins" % len(latencies))
+                key.fileobj.sendto(state[2], ("localhost", port))
+                state[3] = now
+                state[4] += 1
+        for key, _ in events:
+            sock, state = key.fileobj, key.data
+            parsed = util.parse_datagram(sock.recv(batch_io.BUFFER_SIZE))
+            if parsed is None:
+                continue
+            packet_type, _, payload, _ = parsed
+            if packet_type == "data" and b"ERR_SERVER_BUSY" in bytes(payload):
+                state[1] = True
+            elif packet_type == "ack":
+                latencies.append(time.perf_counter() - state[0])
+                busy += state[1]
+                selector.unregister(sock)
+                sock.close()
+    return latencies, busy
+
+
+def percentile(values, share):
+    ordered = sorted(values)
+    return ordered[min(int(len(ordered) * share), len(ordered) - 1)]
+
+
+def run(count, engine, port, concurrency):
+    server = subprocess.Popen([sys.executable, SERVER, "-p", str(port), "-e", engine],
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        time.sleep(1.0)
+        before = rss_kb(server.pid)
+        start = time.perf_counter()
+        latencies, busy = join_users(port, count, concurrency)
+        elapsed = time.perf_counter() - start
+        after = rss_kb(server.pid)
+    finally:
+        server.terminate()
+        server.wait()
+    per_session = "%.2f" % ((after - before) / count) if before is not None and after is not None else "-"
+    print("%8d %12.3f %12.3f %10.2f %10.0f %6d %14s" % (
+        count, percentile(latencies, 0.5) * 1000, percentile(latencies, 0.99) * 1000,
+        elapsed, count / elapsed, busy, per_session))
+
+
+if __name__ == "__main__":
+    def helper():
+        print("Session capacity benchmark")
+        print("-u USERS | --users=USERS Comma separated user counts, defaults to 10,1000,10000")
+        print("-e ENGINE | --engine=ENGINE The server engine, thread or asyncio, defaults to asyncio")
+        print("-p PORT | --port=PORT The server port, defaults to 15500")
+        print("-j JOINS | --concurrency=JOINS Joins in flight at a time, defaults to 64")
+
+    try:
+        OPTS, ARGS = getopt.getopt(sys.argv[1:], "u:e:p:j:h", ["users=", "engine=", "port=", "concurrency=", "help"])
+    except getopt.GetoptError:
+        helper()
+        exit(1)
+
+    USERS = [10, 1000, 10000]
+    ENGINE = "asyncio"
+    PORT = 15500
+    CONCURRENCY = 64
+    for o, a in OPTS:
+        if o in ("-u", "--users"):
+            USERS = [int(count) for count in a.split(",")]
+        elif o in ("-e", "--engine"):
+            ENGINE = a
+        elif o in ("-p", "--port"):
+            PORT = int(a)
+        elif o in ("-j", "--concurrency"):
+            CONCURRENCY = int(a)
+        elif o in ("-h", "--help"):
+            helper()
+            exit()
+
+    print("%8s %12s %12s %10s %10s %6s %14s" % ("users", "p50 join ms", "p99 join ms", "total s", "joins/s", "busy", "KB/session"))
+    for COUNT in USERS:
+        run(COUNT, ENGINE, PORT, CONCURRENCY)
@@ -6,15 +6,24 @@ import sys
 import getopt
 import socket
 import random
-from threading import Thread, Lock, Event
+from threading import Thread, Lock, RLock
+from collections import deque
 import os
 import util
+import batch_io
 import time
-from performance_monitor import performance_monitor
+import rtt
+import fragmentation
+import scheduler
+import performance_monitor
 
 # Constants for retransmission logic
-RETRY_TIMEOUT = 0.5  # 500ms
-MAX_RETRIES = 5
+GIVE_UP_TIMEOUT = 10.0  # a packet unacknowledged for 10s means the server is gone
+KEEPALIVE_INTERVAL = 5.0  # ping the server after 5s without sending, it expires silent sessions
+# bytes of commands coalesced into one batch packet
+BATCH_BUDGET = fragmentation.MAX_CHUNK - 16
+# packets from the server held ahead of a missing one
+MAX_REORDER = util.MAX_REORDER
 
 class Client:
     # Define a global variable for the available commands
@@ -29,7 +38,8 @@ Available commands:
 |  quit - Disconnect and quit the application
 """
 
-    def __init__(self, username, dest, port, window_size, on_message=None):
+    def __init__(self, username, dest, port, window_size, on_message=None, window_mode="gbn", wire_format="text", coalesce_delay=0,
+                 compression=False, performance=False):
         self.server_addr = dest
         self.server_port = port
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
@@ -37,24 +47,50 @@ Available commands:
         self.sock.bind(('', random.randint(10000, 40000)))
         self.name = username
         self.active = True
+        self.last_sent = time.time()
         self.seq_num = 0
         self.on_message = on_message
-        self.pending_packets = {}
+        self.pending_packets = {}  # seq_num -> [packet, retransmission timer, retry_count, sent_time, first_sent_time]
         self.pending_packets_lock = Lock()
-        self.packet_updated = Event()
+        self.rtt = rtt.RttEstimator()
+        # retransmission timers, run by retransmission_handler
+        self.timers = scheduler.ThreadedScheduler()
+        # sliding window: at most window_size packets in flight, the rest wait in send_queue
+        self.window_size = max(1, int(window_size))
+        self.window_mode = window_mode
+        self.send_queue = deque()
+        # "binary" asks the server for the binary wire format, it is used once the server answers in it
+        self.wire_format = wire_format
+        self.binary = False
+        # with the binary format, ask the server to compress large payloads and compress ours
+        self.compression = compression
+        # messages larger than one datagram travel in fragments
+        self.reassembly = fragmentation.Reassembler()
+        self.next_fid = 0
+        # coalescing: messages wait up to coalesce_delay seconds to share one batch packet, 0 disables it
+        self.coalesce_delay = coalesce_delay
+        self.coalesced = []
+        self.coalesced_size = 0
+        self.coalesce_timer = None
+        # also held while sequence numbers are allocated, the timer thread sends too
+        self.coalesce_lock = RLock()
         self.forward = False
         self.data = ""
         self.user = ""
         self.my_username= ""
         self.recv_seq_num = -1
+        # seq -> (packet_type, payload, flags) of packets received ahead of a gap
+        self.reorder = {}
         self.current_message = {}
         self.ack_check = 0
         self.msg_start = 0
         self.msg_buffer = 0
         self.msg_seq_nums =[]
 
-        # Performance monitoring
-        self.perf_monitor = performance_monitor
+        # Performance monitoring, off unless enabled: the hooks cost one check while it is None
+        self.perf_monitor = None
+        if performance:
+            self.enable_performance_monitor()
 
     def start(self):
         '''
@@ -88,13 +124,14 @@ Available commands:
                     print(self.HELP_MESSAGE)
                 elif command.lower() == 'perf':
                     # show current performance stats
+                    self.enable_performance_monitor()
                     self.show_performance_stats()
                 elif command.lower() == 'perf_report':
                     # show detailed performance report
-                    print(self.perf_monitor.get_performance_report())
+                    print(self.enable_performance_monitor().get_performance_report())
                 elif command.lower() == 'perf_reset':
                     # reset performance statistics
-                    self.perf_monitor.reset_stats()
+                    self.enable_performance_monitor().reset_stats()
                     print("Performans istatistikleri sıfırlandı.")
                 else:
                     # print message for incorrect user input
@@ -104,10 +141,22 @@ Available commands:
                     break
         finally:
             # stop performance monitoring
-            self.perf_monitor.stop_monitoring()
+            if self.perf_monitor is not None:
+                self.perf_monitor.stop_monitoring()
             # close the socket
             self.sock.close()
 
+    def enable_performance_monitor(self, persist=False):
+        '''
+        Starts recording performance statistics, from this point on. With persist the statistics
+        are also appended to the performance log every few seconds. Returns the monitor.
+        '''
+        if self.perf_monitor is None:
+            self.perf_monitor = performance_monitor.get_monitor()
+        if persist:
+            self.perf_monitor.start_collection()
+        return self.perf_monitor
+
     def show_performance_stats(self):
         """Display current performance statistics"""
         stats = self.perf_monitor.get_current_stats()
@@ -117,6 +166,7 @@ Oturum süresi: {stats['session_duration']:.1f}s
 Gönderilen mesaj: {stats['total_messages_sent']}
 Alınan mesaj: {stats['total_messages_received']}
 Ortalama gecikme: {stats.get('avg_latency_ms', 0):.1f}ms
+Gecikme p50/p99/p99.9: {stats.get('p50_latency_ms', 0):.1f}/{stats.get('p99_latency_ms', 0):.1f}/{stats.get('p999_latency_ms', 0):.1f}ms
 Mesaj/saniye: {stats['messages_per_second']:.1f}
 Paket kaybı: {stats['packet_loss_rate']:.1f}%
         """)
@@ -130,116 +180,315 @@ Paket kaybı: {stats['packet_loss_rate']:.1f}%
 
     def error_handler(self, message):
         '''
-        Handle error messages from the server
+        Handle error messages from the server.
+        Returns True if message was an error, it is not shown as a chat message.
         '''
-        # check for error recieved from server or user list response
-        if "ERR_SERVER_FULL" in message:
+        # the error code is the first word, a chat message merely containing one is not an error
+        code = message.split(' ', 1)[0]
+        if code == "ERR_SERVER_BUSY":
+            # the server is overloaded, join again after the delay it asked for
+            try:
+                retry_after = float(message.split()[2])
+            except (IndexError, ValueError):
+                retry_after = 1.0
+            self._show_message(f"server busy, retrying in {retry_after:.1f}s")
+            self.timers.call_later(retry_after, self.rejoin)
+        elif code == "ERR_THROTTLED":
+            # the last message went over the send limit of the server and was dropped
+            try:
+                retry_after = float(message.split()[2])
+            except (IndexError, ValueError):
+                retry_after = 1.0
+            self._show_message(f"message dropped: rate limited, retry in {retry_after:.2f}s")
+        elif code == "ERR_SERVER_FULL":
             # print disonnect message to server for server full
             print("disconnected: server full")
             self.active = False
+            self.timers.stop()
             self.sock.close()
-        elif "ERR_USERNAME_UNAVAILABLE" in message:
+        elif code == "ERR_USERNAME_UNAVAILABLE":
             # print disonnect message to server for username not available
             print("disconnected: username not available")
             self.active = False
+            self.timers.stop()
             self.sock.close()
-        elif "ERR_UNKNOWN_MESSAGE" in message:
+        elif code == "ERR_UNKNOWN_MESSAGE":
             # print disonnect message to server for unknown message
             print("disconnected: server received an unknown message")
             self.active = False
+            self.timers.stop()
             self.sock.close()
+        else:
+            return False
+        return True
 
     def receive_handler(self):
         '''
-        Waits for a message from the server and processes it accordingly
+        Waits for messages from the server and processes them accordingly.
+        Every datagram already queued on the socket is read in one batch.
+        The receive state is not locked, only one thread may run this.
         '''
+        receiver = batch_io.BatchReceiver(self.sock)
         while self.active:
             try:
                 # receive data from the server
+                packets = receiver.receive()
                 receive_time = time.time()
-                data, _ = self.sock.recvfrom(1024)  
-                packet_type, seq_num_str, message, _ = util.parse_packet(data.decode())
-
-                if packet_type == 'ack':
-                    ack_seq_num = int(seq_num_str)
-                    acked_packet_seq = ack_seq_num - 1
-                    # Sadece ACK paketleri için performance monitor'e bildir
-                    self.perf_monitor.record_message_received(acked_packet_seq, len(data), receive_time)
-                    with self.pending_packets_lock:
-                        if acked_packet_seq in self.pending_packets:
-                            del self.pending_packets[acked_packet_seq]
-                    continue
-
-                self.error_handler(message)
-
-                if self.active is False:
-                    break
-
-                if "RESPONSE_USERS_LIST" in message:
-                    # split the message into parts
-                    message_parts = message.split()
-                    if len(message_parts) <= 2:
-                        # print message to server for unknown message
-                        self._show_message("ERROR: Received incorrectly formatted RESPONSE_USERS_LIST message.")
-                        break
-                    else:
-                        # get the list of users
-                        users = ' '.join(message_parts[2:])
-                        # print the list of users
-                        self._show_message(f"list: {users.replace(', ', ' ')}")
-                else:
-                    # split the message into parts
-                    message_parts = message.split(' ', 2)
-                    if len(message_parts) <= 2:
-                        # print message to server for unknown message
-                        self._show_message("ERROR: Received incorrectly formatted message.")
-                        break
-                    else:
-                        _, _, content = message_parts
-                        # print the message
-                        self._show_message("msg: " + content)
-
+                for data, _ in packets:
+                    if not self.process_packet(data, receive_time):
+                        return
             except Exception as e:
                 break
 
+    def process_packet(self, data, receive_time):
+        '''
+        Processes one packet from the server. Returns False when the client should stop receiving.
+        '''
+        parsed = util.parse_datagram(data)
+        if parsed is None:
+            # corrupted packet, the server retransmits it
+            return True
+        packet_type, seq_num, payload, flags = parsed
+        if util.is_binary_packet(data):
+            # the server accepted the binary format
+            self.binary = self.wire_format == "binary"
+
+        if packet_type == 'ack':
+            ack_seq_num = seq_num
+            # ACKs are cumulative: every packet below ack_seq_num has arrived,
+            # the message lists the packets the server holds out of order (selective ACK)
+            sacked = util.parse_sack(str(payload, 'utf-8'), ack_seq_num,
+                                     min(self.seq_num, ack_seq_num + MAX_REORDER)) if payload else ()
+            with self.pending_packets_lock:
+                newest = self.pending_packets.get(ack_seq_num - 1)
+                if newest is not None and newest[2] == 0:
+                    # Karn's rule: only packets sent once give an unambiguous RTT sample
+                    self.rtt.sample(receive_time - newest[3])
+                acked = [seq for seq in self.pending_packets if seq < ack_seq_num or seq in sacked]
+                for seq in acked:
+                    self.pending_packets.pop(seq)[1].cancel()
+                if acked:
+                    self.rtt.progress()
+                ready = self._fill_window()
+            # Sadece ACK paketleri için performance monitor'e bildir
+            monitor = self.perf_monitor
+            if monitor is not None:
+                for seq in acked:
+                    monitor.record_message_received(seq, len(data) if seq == ack_seq_num - 1 else 0, receive_time)
+            for seq, packet in ready:
+                self._transmit(seq, packet)
+            return True
+
+        # acknowledge every data packet, duplicates and packets after a gap included,
+        # the ACK carries the next sequence number expected from the server
+        # and lists the packets held out of order (selective ACK)
+        ready = ()
+        if seq_num == self.recv_seq_num + 1:
+            self.recv_seq_num = seq_num
+            ready = [(packet_type, payload, flags)]
+            while self.recv_seq_num + 1 in self.reorder:
+                self.recv_seq_num += 1
+                ready.append(self.reorder.pop(self.recv_seq_num))
+        elif self.recv_seq_num + 1 < seq_num <= self.recv_seq_num + MAX_REORDER:
+            # arrived ahead of a missing packet, the received payload lives in a buffer that is reused
+            self.reorder[seq_num] = (packet_type, bytes(payload), flags)
+        ack_packet = self._make_packet('ack', self.recv_seq_num + 1, util.make_sack(self.reorder).encode())
+        self.sock.sendto(ack_packet, (self.server_addr, self.server_port))
+        self.last_sent = receive_time
+        for packet_type, payload, flags in ready:
+            if not self._deliver(packet_type, payload, flags):
+                return False
+        return True
+
+    def _deliver(self, packet_type, payload, flags):
+        '''
+        Handles a packet received in order. Returns False when the client should stop receiving.
+        '''
+        if packet_type == 'frag':
+            try:
+                payload = self.reassembly.add(payload)
+                if payload is not None and flags & util.FLAG_ZLIB:
+                    payload = util.decompress_payload(payload)
+            except ValueError:
+                return True
+            if payload is None:
+                # more fragments to come
+                return True
+        message = str(payload, 'utf-8')
+
+        if self.error_handler(message):
+            # error notices are not chat messages, the fatal ones stop the client
+            return self.active
+
+        if "RESPONSE_USERS_LIST" in message:
+            # split the message into parts
+            message_parts = message.split()
+            if len(message_parts) <= 2:
+                # print message to server for unknown message
+                self._show_message("ERROR: Received incorrectly formatted RESPONSE_USERS_LIST message.")
+                return False
+            else:
+                # get the list of users
+                users = ' '.join(message_parts[2:])
+                # print the list of users
+                self._show_message(f"list: {users.replace(', ', ' ')}")
+        else:
+            # split the message into parts
+            message_parts = message.split(' ', 2)
+            if len(message_parts) <= 2:
+                # print message to server for unknown message
+                self._show_message("ERROR: Received incorrectly formatted message.")
+                return False
+            else:
+                _, _, content = message_parts
+                # print the message
+                self._show_message("msg: " + content)
+        return True
+
     def _show_message(self, message):
         if self.on_message:
             self.on_message(message)
         else:
             print(message)
 
-    def _send_reliable_packet(self, packet):
-        """Helper function to send a packet and add it to the pending list."""
+    def _make_packet(self, msg_type, seq_num, payload, flags=0):
+        """Builds a packet in the wire format in use from the encoded payload."""
+        if self.binary:
+            return util.make_binary_packet(msg_type, seq_num, payload, flags=flags)
+        return util.make_packet_bytes(msg_type, seq_num, payload)
+
+    def _send_data(self, message):
+        """Sends a message with the next sequence numbers, in fragments if it does not fit one datagram."""
+        payload, flags = message.encode(), 0
+        if self.binary and self.compression:
+            # compressed before it is split, so compression also saves fragments
+            payload, flags = util.compress_payload(payload)
+        if len(payload) <= fragmentation.MAX_CHUNK:
+            parts = [("data", payload)]
+        else:
+            self.next_fid += 1
+            parts = [("frag", part) for part in fragmentation.split(payload, self.next_fid)]
+        with self.coalesce_lock:
+            for msg_type, part in parts:
+                self._send_reliable_packet(self.seq_num, self._make_packet(msg_type, self.seq_num, part, flags))
+                self.seq_num += 1
+
+    def _send_reliable_packet(self, seq_num, packet):
+        """Helper function to send a packet inside the window, or queue it until the window slides."""
         with self.pending_packets_lock:
-            seq_num_str, _ = packet.split('|', 2)[1:3]
-            seq_num = int(seq_num_str)
-            self.pending_packets[seq_num] = (packet, time.time(), 0) # packet, sent_time, retry_count
-        
+            if len(self.pending_packets) >= self.window_size or self.send_queue:
+                self.send_queue.append((seq_num, packet))
+                return
+            self._track(seq_num, packet)
+        self._transmit(seq_num, packet)
+
+    def _fill_window(self):
+        """Moves queued packets into the window. Must be called with pending_packets_lock held."""
+        ready = []
+        while self.send_queue and len(self.pending_packets) < self.window_size:
+            seq_num, packet = self.send_queue.popleft()
+            self._track(seq_num, packet)
+            ready.append((seq_num, packet))
+        return ready
+
+    def _track(self, seq_num, packet):
+        """Starts the retransmission timer of a packet entering the window. Must be called with pending_packets_lock held."""
+        now = time.time()
+        timer = self.timers.call_later(self.rtt.timeout(), self._retransmit, seq_num)
+        self.pending_packets[seq_num] = [packet, timer, 0, now, now]
+
+    def _transmit(self, seq_num, packet):
+        """Sends a packet that entered the window for the first time."""
         # Record sent message for performance monitoring
         send_time = time.time()
-        packet_size = len(packet.encode())
-        self.perf_monitor.record_message_sent(seq_num, packet_size, send_time)
-        
-        self.sock.sendto(packet.encode(), (self.server_addr, self.server_port))
+        if self.perf_monitor is not None:
+            self.perf_monitor.record_message_sent(seq_num, len(packet), send_time)
+
+        self.sock.sendto(packet, (self.server_addr, self.server_port))
+        self.last_sent = send_time
+
+    def _coalesce(self, command):
+        """Queues a command for the next batch packet, sent after coalesce_delay or once BATCH_BUDGET is reached."""
+        size = len(command.encode()) + len(str(len(command))) + 1
+        with self.coalesce_lock:
+            if self.coalesced_size + size > BATCH_BUDGET:
+                self.flush_coalesced()
+            if size > BATCH_BUDGET:
+                self._send_data(command)
+                return
+            self.coalesced.append(command)
+            self.coalesced_size += size
+            if self.coalesce_timer is None:
+                self.coalesce_timer = self.timers.call_later(self.coalesce_delay, self.flush_coalesced)
+
+    def flush_coalesced(self):
+        """Sends the queued commands, a single one as it is and several in one batch packet."""
+        with self.coalesce_lock:
+            if self.coalesce_timer is not None:
+                self.coalesce_timer.cancel()
+                self.coalesce_timer = None
+            commands, self.coalesced, self.coalesced_size = self.coalesced, [], 0
+            if len(commands) == 1:
+                self._send_data(commands[0])
+            elif commands:
+                self._send_data(util.make_message("batch", 1, util.make_batch(commands)))
 
     def join(self):
         '''
         Send a JOIN message to the server
         '''
-        join_message = util.make_message("join", 1, self.name)
-        join_packet = util.make_packet("data", self.seq_num, join_message)
-        self._send_reliable_packet(join_packet)
-        self.seq_num += 1
+        with self.coalesce_lock:
+            # the start packet tells the server that this client acknowledges its packets,
+            # and negotiates the binary format, the server answers in it if it supports it
+            options = [util.RELIABLE_OPTION]
+            if self.wire_format == "binary":
+                options.append(util.BINARY_OPTION)
+                if self.compression:
+                    options.append(util.COMPRESSION_OPTION)
+            start_packet = util.make_packet("start", self.seq_num, ','.join(options)).encode()
+            self._send_reliable_packet(self.seq_num, start_packet)
+            self.seq_num += 1
+            join_message = util.make_message("join", 1, self.name)
+            join_packet = self._make_packet("data", self.seq_num, join_message.encode())
+            self._send_reliable_packet(self.seq_num, join_packet)
+            self.seq_num += 1
+        self.timers.call_later(KEEPALIVE_INTERVAL, self.keepalive)
         return
 
+    def rejoin(self):
+        '''
+        Sends the JOIN message again after the server was busy
+        '''
+        if self.active:
+            self._send_data(util.make_message("join", 1, self.name))
+
+    def keepalive(self):
+        '''
+        Sends a ping when nothing was sent for KEEPALIVE_INTERVAL, so the server keeps the session
+        '''
+        if not self.active:
+            return
+        idle = time.time() - self.last_sent
+        if idle >= KEEPALIVE_INTERVAL:
+            try:
+                self.sock.sendto(self._make_packet('ping', 0, b''), (self.server_addr, self.server_port))
+            except OSError:
+                return
+            self.last_sent = time.time()
+            idle = 0
+        self.timers.call_later(KEEPALIVE_INTERVAL - idle, self.keepalive)
+
     def quit(self):
         '''
         Send a QUIT message to the server
         '''
+        self.flush_coalesced()
         disconnect_message = util.make_message("disconnect", 1, self.name)
-        disconnect_message_packet = util.make_packet("data", self.seq_num, disconnect_message)
-        self._send_reliable_packet(disconnect_message_packet)
+        with self.coalesce_lock:
+            disconnect_message_packet = self._make_packet("data", self.seq_num, disconnect_message.encode())
+            self._send_reliable_packet(self.seq_num, disconnect_message_packet)
         self.active = False
+        self.timers.stop()
         print("quitting")
         return
 
@@ -254,56 +503,76 @@ Paket kaybı: {stats['packet_loss_rate']:.1f}%
             num_users = len(users)
             user_message_part = f"{num_users} " + " ".join(users) + " " + text
             user_msg_message = util.make_message('send_message', 4, user_message_part)
-            message_packet = util.make_packet("data", self.seq_num, user_msg_message)
-            self._send_reliable_packet(message_packet)
-            self.seq_num += 1
-            return
         except (ValueError, IndexError):
             print("incorrect userinput format")
             return
+        try:
+            if self.coalesce_delay > 0:
+                self._coalesce(user_msg_message)
+            else:
+                self._send_data(user_msg_message)
+        except ValueError:
+            # more than fragmentation.MAX_FRAGMENTS fragments
+            print(f"message too long, at most {fragmentation.MAX_FRAGMENTS * fragmentation.MAX_CHUNK} bytes can be sent")
 
     def list(self):
         '''
         Send a LIST message to the server
         '''
+        # queued messages go first
+        self.flush_coalesced()
         # send request to server for list of users
         list_message = util.make_message("request_users_list", 2)
-        list_message_packet = util.make_packet("data", self.seq_num, list_message)
-        self._send_reliable_packet(list_message_packet)
-        self.seq_num += 1
+        with self.coalesce_lock:
+            list_message_packet = self._make_packet("data", self.seq_num, list_message.encode())
+            self._send_reliable_packet(self.seq_num, list_message_packet)
+            self.seq_num += 1
         return
 
     def retransmission_handler(self):
         """
-        Periodically checks for packets that have not been acknowledged and retransmits them.
+        Runs the retransmission timers until the client stops, then closes the socket.
         """
-        while self.active:
-            time.sleep(RETRY_TIMEOUT)
-            
-            with self.pending_packets_lock:
-                current_time = time.time()
-                # Iterate over a copy of items, as we might modify the dict
-                for seq_num, (packet, sent_time, retry_count) in list(self.pending_packets.items()):
-                    if current_time - sent_time > RETRY_TIMEOUT:
-                        if retry_count >= MAX_RETRIES:
-                            # Too many retries, server is likely down
-                            self._show_message("Server not responding. Disconnecting.")
-                            self.active = False
-                            # No need to remove from dict, the client will shut down
-                            break
-                        else:
-                            # Retransmit
-                            self._show_message(f"Timeout for packet {seq_num}. Retrying... ({retry_count + 1})")
-                            
-                            # Record retransmission for performance monitoring
-                            self.perf_monitor.record_retransmission(seq_num)
-                            
-                            self.sock.sendto(packet.encode(), (self.server_addr, self.server_port))
-                            # Update the packet's info in the dict
-                            self.pending_packets[seq_num] = (packet, current_time, retry_count + 1)
-            if not self.active:
-                self.sock.close()
-                break
+        self.timers.run()
+        self.sock.close()
+
+    def _retransmit(self, seq_num):
+        """
+        Retransmission timer of one packet.
+        The timeout comes from the measured RTT and doubles when the oldest packet times out, until new data is acknowledged.
+        Go-Back-N retransmits the whole window once a packet times out,
+        selective repeat retransmits only the packet that timed out.
+        """
+        with self.pending_packets_lock:
+            entry = self.pending_packets.get(seq_num)
+            if entry is None or not self.active:
+                return
+            current_time = time.time()
+            if current_time - entry[4] >= GIVE_UP_TIMEOUT:
+                # No ACK for too long, server is likely down
+                self._show_message("Server not responding. Disconnecting.")
+                self.active = False
+                self.timers.stop()
+                return
+            if seq_num == min(self.pending_packets):
+                self.rtt.on_timeout()
+            resend = sorted(self.pending_packets) if self.window_mode == "gbn" else [seq_num]
+            timeout = self.rtt.timeout()
+            for seq in resend:
+                entry = self.pending_packets[seq]
+                self._show_message(f"Timeout for packet {seq}. Retrying... ({entry[2] + 1})")
+
+                # Record retransmission for performance monitoring
+                if self.perf_monitor is not None:
+                    self.perf_monitor.record_retransmission(seq)
+
+                self.sock.sendto(entry[0], (self.server_addr, self.server_port))
+                self.last_sent = current_time
+                # restart the timer of the packet
+                entry[1].cancel()
+                entry[1] = self.timers.call_later(timeout, self._retransmit, seq)
+                entry[2] += 1
+                entry[3] = current_time
 
 if __name__ == "__main__":
     def helper():
@@ -315,11 +584,17 @@ if __name__ == "__main__":
         print("-p PORT | --port=PORT The server port, defaults to 15000")
         print("-a ADDRESS | --address=ADDRESS The server ip or hostname, defaults to localhost")
         print("-w WINDOW_SIZE | --window=WINDOW_SIZE The window_size, defaults to 3")
+        print("-m MODE | --mode=MODE The sliding window mode, gbn (Go-Back-N) or sr (selective repeat), defaults to gbn")
+        print("-f FORMAT | --format=FORMAT The wire format, text or binary (if the server supports it), defaults to text")
+        print("-z | --compress Compress large messages, needs the binary format")
+        print("-c DELAY_MS | --coalesce=DELAY_MS Wait up to DELAY_MS to send several messages in one packet, defaults to 0 (off)")
+        print("-P | --perf-log Record performance statistics from the start and append them to performance_logs/")
         print("-h | --help Print this help")
 
     try:
         OPTS, ARGS = getopt.getopt(sys.argv[1:],
-                                   "u:p:a:w", ["user=", "port=", "address=", "window="])
+                                   "u:p:a:w:m:f:c:zP", ["user=", "port=", "address=", "window=", "mode=", "format=", "coalesce=", "compress",
+                                                          "perf-log"])
     except getopt.error:
         helper()
         exit(1)
@@ -328,6 +603,11 @@ if __name__ == "__main__":
     DEST = "localhost"
     USER_NAME = None
     WINDOW_SIZE = 3
+    WINDOW_MODE = "gbn"
+    WIRE_FORMAT = "text"
+    COALESCE_DELAY = 0
+    COMPRESSION = False
+    PERF_LOG = False
     for o, a in OPTS:
         if o in ("-u", "--user="):
             USER_NAME = a
@@ -335,21 +615,35 @@ if __name__ == "__main__":
             PORT = int(a)
         elif o in ("-a", "--address="):
             DEST = a
-        elif o in ("-w", "--window="):
-            WINDOW_SIZE = a
+        elif o in ("-w", "--window"):
+            WINDOW_SIZE = int(a)
+        elif o in ("-m", "--mode"):
+            if a not in ("gbn", "sr"):
+                helper()
+                exit(1)
+            WINDOW_MODE = a
+        elif o in ("-f", "--format"):
+            if a not in ("text", "binary"):
+                helper()
+                exit(1)
+            WIRE_FORMAT = a
+        elif o in ("-c", "--coalesce"):
+            COALESCE_DELAY = int(a) / 1000
+        elif o in ("-z", "--compress"):
+            COMPRESSION = True
+        elif o in ("-P", "--perf-log"):
+            PERF_LOG = True
 
     if USER_NAME is None:
         print("Missing Username.")
         helper()
         exit(1)
 
-    S = Client(USER_NAME, DEST, PORT, WINDOW_SIZE)
+    S = Client(USER_NAME, DEST, PORT, WINDOW_SIZE, window_mode=WINDOW_MODE, wire_format=WIRE_FORMAT, coalesce_delay=COALESCE_DELAY, compression=COMPRESSION)
+    if PERF_LOG:
+        S.enable_performance_monitor(persist=True)
     try:
-        # Start receiving Messages
-        T = Thread(target=S.receive_handler)
-        T.daemon = True
-        T.start()
-        # Start Client
+        # Start Client, it starts the receive and retransmission threads
         S.start()
     except (KeyboardInterrupt, SystemExit):
         sys.exit()
\ No newline at end of file
@@ -190,6 +190,9 @@ class ChatGUI(QWidget):
         perf_stats = [
             ("Mesaj/sn:", "msg_per_sec", "0.0"),
             ("Ortalama Gecikme:", "avg_latency", "0 ms"),
+            ("Gecikme p50:", "p50_latency", "0 ms"),
+            ("Gecikme p99:", "p99_latency", "0 ms"),
+            ("Gecikme p99.9:", "p999_latency", "0 ms"),
             ("Paket Kaybı:", "packet_loss", "0%"),
             ("Gönderilen:", "sent_count", "0"),
             ("Alınan:", "received_count", "0")
@@ -227,7 +230,8 @@ class ChatGUI(QWidget):
 
     def connect_to_server(self):
         ClientClass = client.Client
-        self.client = ClientClass(self.username, self.server_addr, self.port, 3, on_message=self.display_message)
+        self.client = ClientClass(self.username, self.server_addr, self.port, 3, on_message=self.display_message,
+                                  performance=True)
         threading.Thread(target=self.client.start, daemon=True).start()
         self.display_message("Sunucuya bağlanılıyor...", 'system')
         QTimer.singleShot(500, self.refresh_users)
@@ -312,12 +316,15 @@ class ChatGUI(QWidget):
                 self.user_listbox.item(i).setSelected(True)
 
     def update_performance_display(self):
-        if self.client and hasattr(self.client, 'perf_monitor'):
+        if self.client and self.client.perf_monitor is not None:
             try:
                 stats = self.client.perf_monitor.get_current_stats()
                 self.perf_labels['msg_per_sec'].setText(f"{stats['messages_per_second']:.1f}")
                 avg_latency = stats.get('avg_latency_ms', 0)
                 self.perf_labels['avg_latency'].setText(f"{avg_latency:.1f} ms")
+                self.perf_labels['p50_latency'].setText(f"{stats.get('p50_latency_ms', 0):.1f} ms")
+                self.perf_labels['p99_latency'].setText(f"{stats.get('p99_latency_ms', 0):.1f} ms")
+                self.perf_labels['p999_latency'].setText(f"{stats.get('p999_latency_ms', 0):.1f} ms")
                 packet_loss = stats['packet_loss_rate']
                 self.perf_labels['packet_loss'].setText(f"{packet_loss:.1f}%")
                 self.perf_labels['sent_count'].setText(str(stats['total_messages_sent']))
@@ -339,7 +346,7 @@ class ChatGUI(QWidget):
                 pass
 
     def show_performance_report(self):
-        if not self.client or not hasattr(self.client, 'perf_monitor'):
+        if not self.client or self.client.perf_monitor is None:
             QMessageBox.warning(self, "Uyarı", "Performans monitörü henüz başlatılmamış.")
             return
         try:
@@ -351,7 +358,7 @@ class ChatGUI(QWidget):
             QMessageBox.critical(self, "Hata", f"Performans raporu oluşturulurken hata: {str(e)}")
 
     def reset_performance_stats(self):
-        if not self.client or not hasattr(self.client, 'perf_monitor'):
+        if not self.client or self.client.perf_monitor is None:
             QMessageBox.warning(self, "Uyarı", "Performans monitörü henüz başlatılmamış.")
             return
         result = QMessageBox.question(self, "Onay", "Performans istatistiklerini sıfırlamak istediğinizden emin misiniz?", QMessageBox.Yes | QMessageBox.No)
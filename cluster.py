@@ -0,0 +1,302 @@
+'''
+This module runs the server as several worker processes sharing one UDP port.
+Every worker binds the port with SO_REUSEPORT, the kernel spreads the clients over the workers
+and the workers exchange routing events over local unix datagram sockets.
+'''
+import os
+import sys
+import json
+import signal
+import socket
+import shutil
+import tempfile
+import multiprocessing
+import logging
+import collections
+import util
+import logs
+import ratelimit
+from logs import log
+from sessions import SessionRegistry
+
+# events are sent to another worker in datagrams of at most this many bytes, a reassembled
+# message of up to util.MAX_DECOMPRESSED_SIZE bytes would not fit the default socket buffer
+EVENT_CHUNK = 65536
+# datagrams waiting for a worker whose queue is full, further events to it are dropped
+MAX_BACKLOG = 1024
+
+
+class ClusterRegistry(SessionRegistry):
+    '''
+    Session registry of one worker.
+    Usernames are claimed in the registry shared by all workers so they stay unique across the cluster.
+    '''
+    def __init__(self, cluster):
+        super().__init__()
+        self.cluster = cluster
+
+    def bind(self, session, username):
+        if self.by_name.get(username) == session.addr:
+            return True
+        if not self.cluster.claim(username, session.addr):
+            return False
+        if not super().bind(session, username):
+            self.cluster.release(username)
+            return False
+        return True
+
+    def unbind(self, session):
+        username = super().unbind(session)
+        if username is not None:
+            self.cluster.release(username)
+        return username
+
+    def usernames(self):
+        return self.by_name.keys() | self.cluster.remote.keys()
+
+    def user_count(self):
+        # the client limit is for the whole cluster, not per worker
+        return len(self.by_name) + len(self.cluster.remote)
+
+
+class Link:
+    '''
+    Connected socket to another worker and the datagrams waiting until its queue has room
+    '''
+    __slots__ = ('sock', 'backlog', 'waiting')
+
+    def __init__(self, path):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sock.setblocking(False)
+        self.backlog = collections.deque()
+        # True while the event loop watches sock for room
+        self.waiting = False
+        try:
+            self.sock.connect(path)
+        except OSError:
+            self.sock.close()
+            raise
+
+
+class Cluster:
+    '''
+    Connects one worker to the others.
+    owners is the shared username -> (worker, addr) registry, remote is this worker's
+    replica of the users owned by the other workers, kept up to date by join/leave events.
+    An event is JSON split into datagrams of "<worker> <event id> <index> <count> " followed by a part.
+    '''
+    def __init__(self, worker_id, num_workers, owners, directory):
+        self.worker_id = worker_id
+        self.owners = owners
+        self.directory = directory
+        self.server = None
+        self.remote = {}
+        for username, (owner, addr) in owners.items():
+            if owner != worker_id:
+                self.remote[username] = (owner, tuple(addr))
+        self.peers = [self.path(i) for i in range(num_workers) if i != worker_id]
+        # peer path -> Link, connected on the first event sent to the peer
+        self.links = {}
+        self.next_event = 0
+        # worker -> [event id, parts received] of the event being received from it
+        self.partial = {}
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sock.bind(self.path(worker_id))
+        self.sock.setblocking(False)
+
+    def path(self, worker_id):
+        return os.path.join(self.directory, "worker-%d.sock" % worker_id)
+
+    def make_registry(self, server):
+        self.server = server
+        return ClusterRegistry(self)
+
+    def claim(self, username, addr):
+        '''
+        Claims username for addr on this worker. Returns False if another client holds it.
+        '''
+        if username in self.remote:
+            return False
+        owner = self.owners.setdefault(username, (self.worker_id, addr))
+        if tuple(owner) != (self.worker_id, addr):
+            return False
+        self._publish(["join", username, self.worker_id, addr])
+        return True
+
+    def release(self, username):
+        owner = self.owners.get(username)
+        if owner is not None and owner[0] == self.worker_id:
+            self.owners.pop(username, None)
+        self._publish(["leave", username])
+
+    def forward(self, sender, username, message):
+        '''
+        Hands message to the worker owning username. Returns False if username is unknown.
+        '''
+        route = self.remote.get(username)
+        if route is None:
+            return False
+        self._send(json.dumps(["msg", sender, username, message]).encode(), self.path(route[0]))
+        return True
+
+    def broadcast(self, sender, message):
+        '''
+        Asks every other worker to deliver message to all of its users
+        '''
+        self._publish(["all", sender, message])
+
+    def receive(self):
+        '''
+        Drains the cluster socket and applies the received events
+        '''
+        while True:
+            try:
+                data = self.sock.recv(EVENT_CHUNK + 64)
+            except (BlockingIOError, InterruptedError):
+                return
+            try:
+                data = self._reassemble(data)
+                if data is None:
+                    continue
+                event = json.loads(data)
+                kind = event[0]
+                if kind == "join":
+                    _, username, owner, addr = event
+                    self.remote[username] = (owner, tuple(addr))
+                elif kind == "leave":
+                    self.remote.pop(event[1], None)
+                elif kind == "msg":
+                    _, sender, username, message = event
+                    self.server.send_message(sender, [username], message)
+                elif kind == "all":
+                    _, sender, message = event
+                    self.server.send_message(sender, list(self.server.sessions.by_name), message)
+            except (ValueError, IndexError, TypeError) as e:
+                log.warning("LOG: Hatalı küme mesajı yoksayıldı: %s", e)
+
+    def _reassemble(self, data):
+        '''
+        Returns the event of which data is the last part, or None while parts are still to come
+        '''
+        worker, event_id, index, count, part = data.split(b' ', 4)
+        worker, event_id, index, count = int(worker), int(event_id), int(index), int(count)
+        if count == 1:
+            return part
+        partial = self.partial.get(worker)
+        if index == 0:
+            partial = self.partial[worker] = [event_id, []]
+        elif partial is None or partial[0] != event_id or len(partial[1]) != index:
+            self.partial.pop(worker, None)
+            raise ValueError("part %d of event %d from worker %d out of order" % (index, event_id, worker))
+        partial[1].append(part)
+        if index + 1 < count:
+            return None
+        del self.partial[worker]
+        return b"".join(partial[1])
+
+    def _publish(self, event):
+        data = json.dumps(event).encode()
+        for peer in self.peers:
+            self._send(data, peer)
+
+    def _send(self, data, peer):
+        '''
+        Queues the encoded event data for peer in datagrams of at most EVENT_CHUNK bytes
+        '''
+        link = self.links.get(peer)
+        if link is None:
+            try:
+                link = self.links[peer] = Link(peer)
+            except OSError as e:
+                log.warning("LOG: Küme mesajı gönderilemedi %s: %s", peer, e)
+                return
+        self.next_event += 1
+        count = max(-(-len(data) // EVENT_CHUNK), 1)
+        if len(link.backlog) + count > MAX_BACKLOG:
+            log.warning("LOG: Küme mesajı gönderilemedi %s: kuyruk dolu", peer)
+            return
+        view = memoryview(data)
+        for index in range(count):
+            link.backlog.append(b"%d %d %d %d " % (self.worker_id, self.next_event, index, count)
+                                + view[index * EVENT_CHUNK:(index + 1) * EVENT_CHUNK])
+        self._flush(peer)
+
+    def _flush(self, peer):
+        '''
+        Sends the backlog of peer until its queue is full, then waits for room on the event loop
+        '''
+        link = self.links[peer]
+        while link.backlog:
+            try:
+                link.sock.send(link.backlog[0])
+            except (BlockingIOError, InterruptedError):
+                if not link.waiting:
+                    self.server.loop.add_writer(link.sock, self._flush, peer)
+                    link.waiting = True
+                return
+            except OSError as e:
+                # the worker is gone, the next event connects again
+                log.warning("LOG: Küme mesajı gönderilemedi %s: %s", peer, e)
+                self._drop(peer)
+                return
+            link.backlog.popleft()
+        if link.waiting:
+            self.server.loop.remove_writer(link.sock)
+            link.waiting = False
+
+    def _drop(self, peer):
+        link = self.links.pop(peer)
+        if link.waiting and self.server.loop is not None:
+            self.server.loop.remove_writer(link.sock)
+        link.sock.close()
+
+    def close(self):
+        for peer in list(self.links):
+            self._drop(peer)
+        self.sock.close()
+
+
+def _worker_main(worker_id, num_workers, owners, directory, dest, port, window, ack_delay, max_clients,
+                 packet_rate, fanout_rate, log_level, log_json, metrics_port):
+    import server
+    logs.setup(log_level, log_json)
+    cluster = Cluster(worker_id, num_workers, owners, directory)
+    worker = server.Server(dest, port, window, "asyncio", cluster=cluster, ack_delay=ack_delay,
+                           max_clients=max_clients, packet_rate=packet_rate, fanout_rate=fanout_rate,
+                           metrics_port=metrics_port + worker_id if metrics_port else 0)
+    try:
+        worker.start()
+    finally:
+        cluster.close()
+        logs.shutdown()
+
+
+def run_workers(num_workers, dest, port, window, ack_delay=0, max_clients=util.MAX_NUM_CLIENTS,
+                packet_rate=ratelimit.PACKET_RATE, fanout_rate=ratelimit.FANOUT_RATE,
+                log_level=logging.INFO, log_json=None, metrics_port=0):
+    '''
+    Starts num_workers server processes on the same port and waits for them
+    '''
+    directory = tempfile.mkdtemp(prefix="chat-cluster-")
+    manager = multiprocessing.Manager()
+    owners = manager.dict()
+    workers = [multiprocessing.Process(target=_worker_main,
+                                       args=(i, num_workers, owners, directory, dest, port, window, ack_delay, max_clients,
+                                             packet_rate, fanout_rate, log_level, log_json, metrics_port),
+                                       daemon=True)
+               for i in range(num_workers)]
+    # stop the workers on SIGTERM as well as on Ctrl-C
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for worker in workers:
+            if worker.is_alive():
+                worker.terminate()
+        manager.shutdown()
+        shutil.rmtree(directory, ignore_errors=True)
@@ -0,0 +1,84 @@
+'''
+Splits messages larger than one datagram into frag packets and puts them back together.
+The payload of a frag packet is "<fid> <index> <count> " followed by a chunk of the message.
+Fragments are ordinary sequenced packets, so they ride the reliable send window like data packets.
+'''
+import time
+import util
+
+# room for the packet header and the fragment header next to a chunk in util.CHUNK_SIZE
+MAX_CHUNK = util.CHUNK_SIZE - 64
+# limits of the reassembly buffer of one peer
+MAX_FRAGMENTS = 256
+MAX_MESSAGES = 4
+REASSEMBLY_TIMEOUT = 30.0
+
+
+def split(payload, fid):
+    '''
+    Returns the frag payloads of payload, the message with the id fid
+    '''
+    count = -(-len(payload) // MAX_CHUNK)
+    if count > MAX_FRAGMENTS:
+        raise ValueError("message too large: %d bytes" % len(payload))
+    view = memoryview(payload)
+    return [b"%d %d %d " % (fid, index, count) + view[index * MAX_CHUNK:(index + 1) * MAX_CHUNK]
+            for index in range(count)]
+
+
+def parse(payload):
+    '''
+    Returns (fid, index, count, chunk) of a frag payload, chunk is a memoryview into payload
+    '''
+    view = memoryview(payload)
+    fid, index, count, _ = bytes(view[:40]).split(b' ', 3)
+    return int(fid), int(index), int(count), view[len(fid) + len(index) + len(count) + 3:]
+
+
+class Reassembler:
+    '''
+    Collects the fragments received from one peer.
+    At most MAX_MESSAGES incomplete messages are kept, a message not completed
+    within REASSEMBLY_TIMEOUT seconds is dropped.
+    '''
+    def __init__(self):
+        # fid -> [deadline, chunks, number of chunks received]
+        self.partial = {}
+
+    def __len__(self):
+        return len(self.partial)
+
+    def add(self, payload):
+        '''
+        Adds a frag payload. Returns the whole message once its last fragment arrived, otherwise None.
+        Raises ValueError for a malformed fragment or when the buffer is full.
+        '''
+        fid, index, count, chunk = parse(payload)
+        now = time.monotonic()
+        self.expire(now)
+        entry = self.partial.get(fid)
+        if entry is None:
+            if not 0 < count <= MAX_FRAGMENTS:
+                raise ValueError("bad fragment count %d" % count)
+            if len(self.partial) >= MAX_MESSAGES:
+                raise ValueError("reassembly buffer full")
+            entry = self.partial[fid] = [now + REASSEMBLY_TIMEOUT, [None] * count, 0]
+        chunks = entry[1]
+        if count != len(chunks) or not 0 <= index < count:
+            raise ValueError("bad fragment %d/%d of message %d" % (index, count, fid))
+        if chunks[index] is None:
+            chunks[index] = bytes(chunk)
+            entry[2] += 1
+        if entry[2] < count:
+            return None
+        del self.partial[fid]
+        return b"".join(chunks)
+
+    def expire(self, now=None):
+        '''
+        Drops the messages whose fragments stopped arriving
+        '''
+        if now is None:
+            now = time.monotonic()
+        for fid in [fid for fid, entry in self.partial.items() if entry[0] <= now]:
+            del self.partial[fid]
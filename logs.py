@@ -0,0 +1,127 @@
+'''
+Logging of the server. The packet loop only puts records on a bounded queue, a background thread
+formats and writes them, so the server never waits for the terminal or the disk.
+When the queue is full records are dropped and counted instead of blocking.
+Per packet records are DEBUG and cost one level check while the level is INFO or above.
+'''
+import os
+import sys
+import json
+import queue
+import atexit
+import logging
+import logging.handlers
+
+# records waiting for the writer thread
+QUEUE_SIZE = 10000
+LEVELS = {"debug": logging.DEBUG, "info": logging.INFO, "warning": logging.WARNING, "error": logging.ERROR}
+
+log = logging.getLogger("chat")
+_listener = None
+# process that started the writer thread
+_owner = None
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    '''
+    Queue handler that never blocks: records arriving at a full queue are counted in dropped
+    and reported with the next record that fits.
+    '''
+    def __init__(self, records):
+        super().__init__(records)
+        self.dropped = 0
+        self.unreported = 0
+
+    def prepare(self, record):
+        # formatting is left to the writer thread, only a traceback has to be rendered now
+        if record.exc_info:
+            return super().prepare(record)
+        return record
+
+    def enqueue(self, record):
+        try:
+            if self.unreported:
+                self.queue.put_nowait(logging.LogRecord(
+                    record.name, logging.WARNING, __file__, 0,
+                    "LOG: Kayıt kuyruğu dolu, %d kayıt atıldı", (self.unreported,), None))
+                self.unreported = 0
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+            self.unreported += 1
+
+
+class JsonFormatter(logging.Formatter):
+    '''
+    One JSON object per line. Fields passed as extra={"fields": {...}} become keys of the object.
+    '''
+    def format(self, record):
+        entry = {
+            "time": record.created,
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        fields = getattr(record, "fields", None)
+        if fields:
+            entry.update(fields)
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class _Listener(logging.handlers.QueueListener):
+    def enqueue_sentinel(self):
+        # wait for room instead of failing on a full queue
+        self.queue.put(self._sentinel)
+
+
+def setup(level=logging.INFO, json_path=None, console=True, queue_size=QUEUE_SIZE):
+    '''
+    Starts the writer thread of the chat loggers.
+    Records go to stdout as plain text and, if json_path is given, to that file as JSON lines.
+    Returns the queue handler, its dropped attribute counts the records lost to a full queue.
+    '''
+    global _listener, _owner
+    shutdown()
+    handlers = []
+    if console:
+        stream = logging.StreamHandler(sys.stdout)
+        stream.setFormatter(logging.Formatter("%(message)s"))
+        handlers.append(stream)
+    if json_path is not None:
+        sink = logging.FileHandler(json_path, encoding="utf-8")
+        sink.setFormatter(JsonFormatter())
+        handlers.append(sink)
+    handler = DroppingQueueHandler(queue.Queue(queue_size))
+    # a forked worker inherits the handler of its parent, whose writer thread it does not have
+    for old in list(log.handlers):
+        log.removeHandler(old)
+    log.addHandler(handler)
+    log.setLevel(level)
+    log.propagate = False
+    _listener = _Listener(handler.queue, *handlers)
+    _listener.start()
+    _owner = os.getpid()
+    return handler
+
+
+def shutdown():
+    '''
+    Writes the queued records and stops the writer thread
+    '''
+    global _listener
+    if _listener is None:
+        return
+    listener, _listener = _listener, None
+    if _owner != os.getpid():
+        # the writer thread was not copied into this forked process
+        return
+    listener.stop()
+    for handler in listener.handlers:
+        handler.close()
+
+
+atexit.register(shutdown)
@@ -1,24 +1,330 @@
 '''
 Ağ Performansı Optimizasyonu Ölçüm Modülü
 Bu modül chat uygulamasının ağ performansını izler ve optimize eder
+İçe aktarmak hiçbir thread başlatmaz ve dosya yazmaz: ortak monitör ilk get_monitor() çağrısında
+oluşturulur, periyodik toplama ve kayıt start_collection() ile açıkça başlatılır.
 '''
+import math
 import time
 import threading
-import statistics
 from collections import deque, defaultdict
 import json
 import os
 from datetime import datetime, timedelta
 
+# Performans kayıtlarının dizini ve dosya adı öneki
+LOG_DIR = "performance_logs"
+LOG_PREFIX = "performance_log"
+# Bir parça (segment) bu boyuta ya da yaşa ulaşınca yenisine geçilir
+MAX_SEGMENT_BYTES = 1 << 20
+MAX_SEGMENT_AGE = 3600
+# Her sürecin sakladığı en fazla parça sayısı, 0 sınırsız
+MAX_SEGMENTS = 10
+# never: fsync yok, rotate: parça kapanırken, always: her kayıttan sonra
+FSYNC_POLICIES = ("never", "rotate", "always")
+# Periyodik istatistik toplama aralığı, saniye
+COLLECT_INTERVAL = 5
+
+
+# Histogramın çözünürlüğü: her ikinin kuvveti aralığı 2**(LATENCY_SUB_BUCKET_BITS - 1) alt kovaya bölünür,
+# 6 bit ile bir değerin hatası en fazla %1.6
+LATENCY_SUB_BUCKET_BITS = 6
+# Kaydedilen en büyük gecikme, daha büyükleri bu değere kırpılır
+MAX_LATENCY_MS = 3600 * 1000
+PERCENTILES = (50, 90, 99, 99.9)
+
+
+class LatencyHistogram:
+    """Sabit bellekli, log-lineer (HDR tarzı) gecikme histogramı
+
+    Değerler mikrosaniye olarak kovalara sayılır: 2**bits altındaki değerler tam, daha büyükleri
+    göreli hatası sabit kovalarla. Bellek örnek sayısından bağımsızdır, oturumun tüm örnekleri tutulur.
+    Aynı çözünürlükteki histogramlar birleştirilebilir (merge) ve sözlüğe çevrilebilir (to_dict).
+    """
+    def __init__(self, sub_bucket_bits=LATENCY_SUB_BUCKET_BITS, max_value_ms=MAX_LATENCY_MS):
+        self.sub_bucket_bits = sub_bucket_bits
+        self.max_value_ms = max_value_ms
+        self.max_value = int(max_value_ms * 1000)
+        self.counts = [0] * (self._index(self.max_value) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def _index(self, value):
+        sub_count = 1 << self.sub_bucket_bits
+        shift = value.bit_length() - self.sub_bucket_bits
+        if shift <= 0:
+            return value
+        return sub_count + (shift - 1) * (sub_count >> 1) + (value >> shift) - (sub_count >> 1)
+
+    def _bucket_value(self, index):
+        """Kovadaki değerlerin orta noktası, mikrosaniye"""
+        sub_count = 1 << self.sub_bucket_bits
+        if index < sub_count:
+            return index
+        shift, offset = divmod(index - sub_count, sub_count >> 1)
+        shift += 1
+        return ((offset + (sub_count >> 1)) << shift) + (1 << (shift - 1))
+
+    def record(self, value_ms):
+        """Bir gecikme örneği ekle (milisaniye)"""
+        value_ms = min(max(value_ms, 0), self.max_value_ms)
+        self.counts[self._index(int(value_ms * 1000))] += 1
+        self.count += 1
+        self.total += value_ms
+        if self.min is None or value_ms < self.min:
+            self.min = value_ms
+        if self.max is None or value_ms > self.max:
+            self.max = value_ms
+
+    def percentiles(self, points=PERCENTILES):
+        """{yüzdelik: gecikme ms}, tek geçişte hesaplanır"""
+        if not self.count:
+            return {point: 0 for point in points}
+        ordered = sorted(points)
+        result = {}
+        seen = 0
+        position = 0
+        for index, bucket_count in enumerate(self.counts):
+            if not bucket_count:
+                continue
+            seen += bucket_count
+            while position < len(ordered) and seen >= max(1, math.ceil(ordered[position] / 100 * self.count)):
+                # Kovanın orta noktası, gözlenen en küçük ve en büyük değerle sınırlı
+                value = self._bucket_value(index) / 1000
+                result[ordered[position]] = min(max(value, self.min), self.max)
+                position += 1
+            if position == len(ordered):
+                break
+        return result
+
+    def percentile(self, point):
+        return self.percentiles((point,))[point]
+
+    def mean(self):
+        return self.total / self.count if self.count else 0
+
+    def copy(self):
+        """Bağımsız kopya, yüzdelikler kilit dışında kopyadan hesaplanabilir"""
+        histogram = LatencyHistogram.__new__(LatencyHistogram)
+        histogram.__dict__.update(self.__dict__)
+        histogram.counts = list(self.counts)
+        return histogram
+
+    def merge(self, other):
+        """other histogramının örneklerini bu histograma ekle"""
+        if other.sub_bucket_bits != self.sub_bucket_bits or other.max_value_ms != self.max_value_ms:
+            raise ValueError("histograms of different resolution cannot be merged")
+        for index, bucket_count in enumerate(other.counts):
+            if bucket_count:
+                self.counts[index] += bucket_count
+        self.count += other.count
+        self.total += other.total
+        if other.count:
+            self.min = other.min if self.min is None else min(self.min, other.min)
+            self.max = other.max if self.max is None else max(self.max, other.max)
+        return self
+
+    def to_dict(self):
+        """JSON'a yazılabilir sözlük, yalnızca dolu kovalar"""
+        return {
+            "sub_bucket_bits": self.sub_bucket_bits,
+            "max_value_ms": self.max_value_ms,
+            "count": self.count,
+            "total": self.total,
+            "min": self.min,
+            "max": self.max,
+            "buckets": [[index, bucket_count] for index, bucket_count in enumerate(self.counts) if bucket_count],
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        histogram = cls(data["sub_bucket_bits"], data["max_value_ms"])
+        for index, bucket_count in data["buckets"]:
+            histogram.counts[index] += bucket_count
+        histogram.count = data["count"]
+        histogram.total = data["total"]
+        histogram.min = data["min"]
+        histogram.max = data["max"]
+        return histogram
+
+    def reset(self):
+        self.counts = [0] * len(self.counts)
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+
+def merge_logged_histograms(records):
+    """Performans kayıtlarındaki gecikme histogramlarını birleştir
+
+    Her oturumun histogramı birikimlidir, bu yüzden her oturumun (pid ve başlangıç zamanı) yalnızca
+    son kaydı alınır. Örneğin: merge_logged_histograms(read_performance_log())
+    """
+    latest = {}
+    for record in records:
+        data = record.get("latency_histogram")
+        if data is not None:
+            latest[(record.get("pid"), record.get("session_start"))] = data
+    merged = LatencyHistogram()
+    for data in latest.values():
+        merged.merge(LatencyHistogram.from_dict(data))
+    return merged
+
+
+class RateCounter:
+    """Saniyelik kovalarla olay hızı
+
+    Yalnızca içinde bulunulan ve bir önceki saniyenin sayıları tutulur. Son bir saniyedeki
+    olay sayısı, önceki saniyenin pencerede kalan payı ile yaklaşık hesaplanır, O(1).
+    """
+    def __init__(self):
+        self.second = 0
+        self.current = 0
+        self.previous = 0
+
+    def _advance(self, now):
+        second = int(now)
+        if second != self.second:
+            self.previous = self.current if second == self.second + 1 else 0
+            self.current = 0
+            self.second = second
+
+    def add(self, now, count=1):
+        self._advance(now)
+        self.current += count
+
+    def rate(self, now):
+        """Son bir saniyedeki olay sayısı"""
+        self._advance(now)
+        return self.previous * (1 - (now - self.second)) + self.current
+
+    def reset(self):
+        self.second = 0
+        self.current = 0
+        self.previous = 0
+
+
+class PerformanceLog:
+    """Yalnızca ekleme yapılan, dönüşümlü JSON-lines performans kaydı
+
+    Her kayıt tek satır olarak dosyanın sonuna yazılır, dosya yeniden okunup yazılmaz.
+    Her süreç kendi dosyalarına yazar, aynı dizini paylaşan istemciler birbirini ezmez.
+    """
+    def __init__(self, directory=LOG_DIR, prefix=LOG_PREFIX, max_bytes=MAX_SEGMENT_BYTES,
+                 max_age=MAX_SEGMENT_AGE, fsync="rotate", max_segments=MAX_SEGMENTS):
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError("fsync must be one of %s" % ", ".join(FSYNC_POLICIES))
+        self.directory = directory
+        self.prefix = prefix
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.fsync = fsync
+        self.max_segments = max_segments
+        self.lock = threading.Lock()
+        self.file = None
+        self.size = 0
+        self.opened = 0
+        self.counter = 0
+        self.closed = False
+        # Bu sürecin yazdığı parçalar, eskiden yeniye
+        self.segments = deque()
+
+    def write(self, record):
+        """Kaydı bir JSON satırı olarak ekle"""
+        line = json.dumps(record, separators=(",", ":"), ensure_ascii=False).encode("utf-8") + b"\n"
+        with self.lock:
+            if self.closed:
+                return
+            if self.file is not None and (self.size >= self.max_bytes or time.time() - self.opened >= self.max_age):
+                self._close_segment()
+            if self.file is None:
+                self._open_segment()
+            self.file.write(line)
+            self.file.flush()
+            self.size += len(line)
+            if self.fsync == "always":
+                os.fsync(self.file.fileno())
+
+    def close(self):
+        """Açık parçayı kapat, sonraki kayıtlar yazılmaz"""
+        with self.lock:
+            self.closed = True
+            if self.file is not None:
+                self._close_segment()
+
+    def _open_segment(self):
+        os.makedirs(self.directory, exist_ok=True)
+        # Ad: önek-zaman-pid-sıra, ada göre sıralama başlangıç zamanına göre sıralar
+        name = "%s-%s-%d-%04d.jsonl" % (self.prefix, time.strftime("%Y%m%d-%H%M%S"), os.getpid(), self.counter)
+        self.counter += 1
+        path = os.path.join(self.directory, name)
+        self.file = open(path, "ab")
+        self.size = self.file.tell()
+        self.opened = time.time()
+        self.segments.append(path)
+        while self.max_segments and len(self.segments) > self.max_segments:
+            try:
+                os.remove(self.segments.popleft())
+            except OSError:
+                pass
+
+    def _close_segment(self):
+        if self.fsync != "never":
+            os.fsync(self.file.fileno())
+        self.file.close()
+        self.file = None
+
+
+def read_performance_log(directory=LOG_DIR, prefix=LOG_PREFIX, since=None):
+    """Tüm parçalardaki kayıtları sırayla döndüren üreteç (generator)
+
+    Dosyalar bütünüyle belleğe alınmaz. since (datetime ya da ISO metni) verilirse
+    daha eski kayıtlar atlanır. Yazılırken ya da çökme sırasında yarım kalan son satır yok sayılır.
+    """
+    if isinstance(since, datetime):
+        since = since.isoformat()
+    try:
+        names = sorted(name for name in os.listdir(directory)
+                       if name.startswith(prefix + "-") and name.endswith(".jsonl"))
+    except FileNotFoundError:
+        return
+    for name in names:
+        try:
+            segment = open(os.path.join(directory, name), "rb")
+        except OSError:
+            # Okunmadan önce dönüşümle silinmiş
+            continue
+        with segment:
+            for line in segment:
+                if not line.endswith(b"\n"):
+                    break
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                if since is not None and record.get("timestamp", "") < since:
+                    continue
+                yield record
+
+
 class PerformanceMonitor:
     def __init__(self, window_size=100):
         self.window_size = window_size
         self.lock = threading.Lock()
         
-        # Performans metrikleri
-        self.latencies = deque(maxlen=window_size)  # RTT süreleri
-        self.message_timestamps = deque(maxlen=window_size)  # Mesaj gönderim zamanları
-        self.packet_sizes = deque(maxlen=window_size)  # Paket boyutları
+        # Performans metrikleri, her örnekte O(1) güncellenir
+        self.latency_histogram = LatencyHistogram()  # Oturumun tüm RTT'leri
+        # Welford ortalama/varyans birikimcileri
+        self.latency_count = 0
+        self.latency_mean = 0.0
+        self.latency_m2 = 0.0
+        # RFC 3550 tarzı jitter: ardışık RTT farklarının 1/16 kazançla yumuşatılmış ortalaması
+        self.last_latency = None
+        self.jitter = 0.0
+        self.message_rate = RateCounter()  # Mesaj gönderim hızı
         self.retransmissions = deque(maxlen=window_size)  # Yeniden gönderim sayıları
         
         # Gerçek zamanlı sayaçlar
@@ -36,12 +342,20 @@ class PerformanceMonitor:
         self.throughput_window = deque(maxlen=10)  # Son 10 saniyenin verileri
         self.last_throughput_check = time.time()
         
-        # Performans logları
+        # Performans logları, start_collection() ile başlar
         self.performance_log = []
-        self.log_file = "performance_log.json"
-        
-        # Performans istatistikleri thread'i
-        self.monitoring_active = True
+        self.log_writer = None
+        self.collect_interval = COLLECT_INTERVAL
+        self.stats_thread = None
+        self.stop_event = threading.Event()
+
+    def start_collection(self, interval=COLLECT_INTERVAL, log_dir=LOG_DIR, fsync="rotate"):
+        """Periyodik istatistik toplamayı ve performans loguna yazmayı başlat"""
+        if self.stats_thread is not None and self.stats_thread.is_alive():
+            return
+        self.collect_interval = interval
+        self.log_writer = PerformanceLog(log_dir, fsync=fsync)
+        self.stop_event.clear()
         self.stats_thread = threading.Thread(target=self._periodic_stats_collection, daemon=True)
         self.stats_thread.start()
 
@@ -52,8 +366,7 @@ class PerformanceMonitor:
         with self.lock:
             self.total_messages_sent += 1
             self.total_bytes_sent += message_size
-            self.message_timestamps.append(timestamp)
-            self.packet_sizes.append(message_size)
+            self.message_rate.add(timestamp)
             # Gönderim zamanını kaydet
             self.pending_messages[seq_num] = timestamp
 
@@ -70,9 +383,20 @@ class PerformanceMonitor:
                 sent_time = self.pending_messages[seq_num]
                 # Alınma zamanından gönderilme zamanını çıkar
                 latency = max(0, (timestamp - sent_time) * 1000)  # milisaniye, negatif olamaz
-                self.latencies.append(latency)
+                self._record_latency(latency)
                 del self.pending_messages[seq_num]
 
+    def _record_latency(self, latency):
+        """Birikimcileri bir RTT örneğiyle güncelle, kilit tutulurken çağrılır"""
+        self.latency_histogram.record(latency)
+        self.latency_count += 1
+        delta = latency - self.latency_mean
+        self.latency_mean += delta / self.latency_count
+        self.latency_m2 += delta * (latency - self.latency_mean)
+        if self.last_latency is not None:
+            self.jitter += (abs(latency - self.last_latency) - self.jitter) / 16
+        self.last_latency = latency
+
     def record_retransmission(self, seq_num):
         """Yeniden gönderim kaydı"""
         with self.lock:
@@ -96,54 +420,43 @@ class PerformanceMonitor:
             }
             
             # Latency istatistikleri
-            if self.latencies:
+            histogram = None
+            if self.latency_count:
                 stats.update({
-                    'avg_latency_ms': statistics.mean(self.latencies),
-                    'min_latency_ms': min(self.latencies),
-                    'max_latency_ms': max(self.latencies),
-                    'latency_stddev_ms': statistics.stdev(self.latencies) if len(self.latencies) > 1 else 0,
-                    'jitter_ms': self._calculate_jitter()
+                    'avg_latency_ms': self.latency_mean,
+                    'min_latency_ms': self.latency_histogram.min,
+                    'max_latency_ms': self.latency_histogram.max,
+                    'latency_stddev_ms': math.sqrt(self.latency_m2 / (self.latency_count - 1)) if self.latency_count > 1 else 0,
+                    'jitter_ms': self.jitter
                 })
+                histogram = self.latency_histogram.copy()
             
             # Throughput hesaplama
             stats.update({
-                'messages_per_second': self._calculate_message_throughput(),
+                'messages_per_second': self.message_rate.rate(current_time),
                 'bytes_per_second': self._calculate_byte_throughput(),
                 'packet_loss_rate': self._calculate_packet_loss_rate(),
                 'retransmission_rate': self._calculate_retransmission_rate()
             })
             
             # Ortalama paket boyutu
-            if self.packet_sizes:
-                stats['avg_packet_size'] = statistics.mean(self.packet_sizes)
-            
-            return stats
-
-    def _calculate_jitter(self):
-        """Jitter hesaplama (latency değişimi)"""
-        if len(self.latencies) < 2:
-            return 0
-        
-        # Ardışık latency'lerin farkları
-        diffs = []
-        for i in range(1, len(self.latencies)):
-            diffs.append(abs(self.latencies[i] - self.latencies[i-1]))
-        
-        return statistics.mean(diffs) if diffs else 0
+            if self.total_messages_sent:
+                stats['avg_packet_size'] = self.total_bytes_sent / self.total_messages_sent
 
-    def _calculate_message_throughput(self):
-        """Mesaj/saniye hesaplama"""
-        current_time = time.time()
-        one_second_ago = current_time - 1.0
-        
-        # Son 1 saniyedeki mesajları say
-        recent_messages = sum(1 for ts in self.message_timestamps if ts > one_second_ago)
-        return recent_messages
+        # Oturumun tamamı üzerinden yüzdelikler, kilit dışında kopyadan
+        if histogram is not None:
+            percentiles = histogram.percentiles()
+            stats.update({
+                'p50_latency_ms': percentiles[50],
+                'p90_latency_ms': percentiles[90],
+                'p99_latency_ms': percentiles[99],
+                'p999_latency_ms': percentiles[99.9],
+            })
+        return stats
 
     def _calculate_byte_throughput(self):
         """Byte/saniye hesaplama"""
-        current_time = time.time()
-        session_duration = current_time - self.session_start_time
+        session_duration = time.time() - self.session_start_time
         
         if session_duration > 0:
             return self.total_bytes_sent / session_duration
@@ -164,10 +477,15 @@ class PerformanceMonitor:
 
     def _periodic_stats_collection(self):
         """Periyodik istatistik toplama"""
-        while self.monitoring_active:
+        while not self.stop_event.is_set():
             try:
                 stats = self.get_current_stats()
                 stats['timestamp'] = datetime.now().isoformat()
+                # Histogram birikimlidir, süreçler ve istemciler arası birleştirme için oturum bilgisiyle yazılır
+                stats['pid'] = os.getpid()
+                stats['session_start'] = self.session_start_time
+                with self.lock:
+                    stats['latency_histogram'] = self.latency_histogram.to_dict()
                 self.performance_log.append(stats)
                 
                 # Log dosyasına yaz
@@ -177,31 +495,16 @@ class PerformanceMonitor:
                 if len(self.performance_log) > 1000:
                     self.performance_log = self.performance_log[-500:]  # Son 500 kaydı tut
                 
-                time.sleep(5)  # 5 saniyede bir istatistik topla
-                
             except Exception as e:
                 print(f"Performans monitoring hatası: {e}")
-                time.sleep(5)
+            # collect_interval saniyede bir istatistik topla, stop_monitoring() beklemeyi keser
+            self.stop_event.wait(self.collect_interval)
 
     def _save_to_file(self, stats):
         """İstatistikleri dosyaya kaydet"""
         try:
-            # Dosya mevcutsa append, yoksa create
-            if os.path.exists(self.log_file):
-                with open(self.log_file, 'r') as f:
-                    data = json.load(f)
-            else:
-                data = []
-            
-            data.append(stats)
-            
-            # Son 1000 kaydı tut
-            if len(data) > 1000:
-                data = data[-1000:]
-            
-            with open(self.log_file, 'w') as f:
-                json.dump(data, f, indent=2)
-                
+            # Tek satır eklenir, dosyanın geri kalanına dokunulmaz
+            self.log_writer.write(stats)
         except Exception as e:
             print(f"Performans log yazma hatası: {e}")
 
@@ -224,6 +527,10 @@ LATENCY (GECİKME):
 - Minimum: {stats.get('min_latency_ms', 0):.2f} ms
 - Maximum: {stats.get('max_latency_ms', 0):.2f} ms
 - Jitter: {stats.get('jitter_ms', 0):.2f} ms
+- p50: {stats.get('p50_latency_ms', 0):.2f} ms
+- p90: {stats.get('p90_latency_ms', 0):.2f} ms
+- p99: {stats.get('p99_latency_ms', 0):.2f} ms
+- p99.9: {stats.get('p999_latency_ms', 0):.2f} ms
 
 THROUGHPUT (AKIŞ HIZI):
 - Mesaj/saniye: {stats['messages_per_second']:.2f}
@@ -273,16 +580,22 @@ TOPLAM VERİ:
 
     def stop_monitoring(self):
         """Monitoring'i durdur"""
-        self.monitoring_active = False
-        if self.stats_thread.is_alive():
+        self.stop_event.set()
+        if self.stats_thread is not None and self.stats_thread.is_alive():
             self.stats_thread.join(timeout=1)
+        if self.log_writer is not None:
+            self.log_writer.close()
 
     def reset_stats(self):
         """İstatistikleri sıfırla"""
         with self.lock:
-            self.latencies.clear()
-            self.message_timestamps.clear()
-            self.packet_sizes.clear()
+            self.latency_histogram.reset()
+            self.latency_count = 0
+            self.latency_mean = 0.0
+            self.latency_m2 = 0.0
+            self.last_latency = None
+            self.jitter = 0.0
+            self.message_rate.reset()
             self.retransmissions.clear()
             self.pending_messages.clear()
             
@@ -293,5 +606,16 @@ TOPLAM VERİ:
             self.total_retransmissions = 0
             self.session_start_time = time.time()
 
-# Global performans monitor instance
-performance_monitor = PerformanceMonitor()
\ No newline at end of file
+# Ortak performans monitörü, ilk kullanımda oluşturulur
+_monitor = None
+_monitor_lock = threading.Lock()
+
+
+def get_monitor():
+    """Ortak PerformanceMonitor örneği, ilk çağrıda oluşturulur"""
+    global _monitor
+    if _monitor is None:
+        with _monitor_lock:
+            if _monitor is None:
+                _monitor = PerformanceMonitor()
+    return _monitor
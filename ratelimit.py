@@ -0,0 +1,105 @@
+'''
+Per-client rate limiting with token buckets.
+Every client address gets a bucket for the packets it sends and one for the recipients
+its messages fan out to, so one flooding client cannot take the receive loop from the others.
+'''
+import time
+
+# defaults of the server, 0 disables a limit
+PACKET_RATE = 2000  # packets per second
+FANOUT_RATE = 20000  # recipients per second
+# addresses tracked before the idle buckets are forgotten
+MAX_TRACKED = 65536
+
+
+class TokenBucket:
+    '''
+    rate tokens per second, at most burst saved up
+    '''
+    __slots__ = ('rate', 'burst', 'tokens', 'stamp')
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = now
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def take(self, now, cost=1):
+        '''
+        Takes cost tokens if available. A cost above the burst is allowed on a full bucket
+        and leaves it in debt, so a huge broadcast still goes out but the next one waits.
+        '''
+        self.refill(now)
+        if self.tokens >= min(cost, self.burst):
+            self.tokens -= cost
+            return True
+        return False
+
+    def wait_time(self, cost=1):
+        '''
+        Seconds until cost tokens are available
+        '''
+        return max(min(cost, self.burst) - self.tokens, 0) / self.rate
+
+
+class RateLimiter:
+    '''
+    Packet and fan-out buckets per client address.
+    The packet bucket allows bursts of twice the rate, the fan-out bucket one second of recipients.
+    '''
+    def __init__(self, packet_rate=PACKET_RATE, fanout_rate=FANOUT_RATE, clock=time.monotonic):
+        self.packet_rate = packet_rate
+        self.fanout_rate = fanout_rate
+        self.clock = clock
+        self.packets = {}
+        self.fanouts = {}
+        # packets dropped over the limit
+        self.dropped = 0
+
+    def allow_packet(self, addr):
+        '''
+        Called for every received packet before it is parsed
+        '''
+        if not self.packet_rate:
+            return True
+        now = self.clock()
+        bucket = self._bucket(self.packets, addr, self.packet_rate, 2 * self.packet_rate, now)
+        if bucket.take(now):
+            return True
+        self.dropped += 1
+        return False
+
+    def allow_fanout(self, addr, recipients):
+        '''
+        Called before a message from addr is forwarded to recipients users.
+        Returns 0 if allowed, otherwise the seconds until it would be.
+        '''
+        if not self.fanout_rate:
+            return 0
+        now = self.clock()
+        bucket = self._bucket(self.fanouts, addr, self.fanout_rate, self.fanout_rate, now)
+        if bucket.take(now, recipients):
+            return 0
+        return bucket.wait_time(recipients)
+
+    def _bucket(self, buckets, addr, rate, burst, now):
+        bucket = buckets.get(addr)
+        if bucket is None:
+            if len(buckets) >= MAX_TRACKED:
+                self._prune(buckets, now)
+            bucket = buckets[addr] = TokenBucket(rate, burst, now)
+        return bucket
+
+    def _prune(self, buckets, now):
+        # a full bucket holds no state worth keeping
+        for addr in list(buckets):
+            bucket = buckets[addr]
+            bucket.refill(now)
+            if bucket.tokens >= bucket.burst:
+                del buckets[addr]
+        if len(buckets) >= MAX_TRACKED:
+            buckets.clear()
@@ -0,0 +1,61 @@
+'''
+Round trip time estimation for the retransmission timers of the client and the server.
+'''
+import util
+
+# the peer may delay an ACK up to MAX_ACK_DELAY, so the timeout must not fire before it could arrive
+MAX_ACK_DELAY = 0.025 # 25ms
+MIN_RTO = 0.05 # 50ms
+MAX_RTO = 8.0
+CLOCK_GRANULARITY = 0.001
+ALPHA = 1 / 8
+BETA = 1 / 4
+
+
+class RttEstimator:
+    '''
+    Retransmission timeout from smoothed RTT samples (Jacobson/Karels, RFC 6298).
+    Samples must only come from packets that were not retransmitted (Karn's rule).
+    Every timeout doubles the RTO up to MAX_RTO until new data is acknowledged.
+    '''
+    __slots__ = ('srtt', 'rttvar', 'rto', 'backoff')
+
+    def __init__(self, initial_rto=util.TIME_OUT):
+        self.srtt = None
+        self.rttvar = None
+        self.rto = initial_rto
+        self.backoff = 0
+
+    def sample(self, rtt):
+        '''
+        Updates the estimate with the RTT of a packet acknowledged on its first transmission
+        '''
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = (1 - BETA) * self.rttvar + BETA * abs(self.srtt - rtt)
+            self.srtt = (1 - ALPHA) * self.srtt + ALPHA * rtt
+        self.rto = min(max(self.srtt + max(CLOCK_GRANULARITY, 4 * self.rttvar), MIN_RTO), MAX_RTO)
+        self.backoff = 0
+
+    def on_timeout(self):
+        '''
+        Exponential backoff after a retransmission timeout
+        '''
+        if self.rto * (2 ** self.backoff) < MAX_RTO:
+            self.backoff += 1
+
+    def progress(self):
+        '''
+        New data was acknowledged, the path works again so the backoff ends.
+        Without this a receiver that drops out of order packets would keep every ACK ambiguous
+        and the RTO would stay at MAX_RTO.
+        '''
+        self.backoff = 0
+
+    def timeout(self):
+        '''
+        Current retransmission timeout including the backoff
+        '''
+        return min(self.rto * (2 ** self.backoff), MAX_RTO)
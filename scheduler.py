@@ -0,0 +1,156 @@
+'''
+Deadline ordered timers shared by the client and the server.
+Timers live in a binary heap: scheduling costs O(log n), cancelling is O(1) because a cancelled
+timer is only skipped when it reaches the top, and the owner sleeps exactly until the next deadline.
+'''
+import heapq
+import time
+import threading
+
+# rebuild the heap when more than half of it is cancelled timers
+COMPACT_MIN = 64
+
+
+class Timer:
+    '''
+    A single scheduled callback, returned by call_later so the caller can cancel it.
+    '''
+    __slots__ = ('when', 'callback', 'args', 'cancelled', 'scheduler')
+
+    def __init__(self, when, callback, args, scheduler):
+        self.when = when
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+        self.scheduler = scheduler
+
+    def __lt__(self, other):
+        return self.when < other.when
+
+    def cancel(self):
+        # read once, the thread running the timers clears it when the timer fires
+        scheduler = self.scheduler
+        if scheduler is None:
+            self.cancelled = True
+        else:
+            scheduler._cancel(self)
+
+
+class Scheduler:
+    '''
+    Timers of a single thread. The owner calls run_due() from its loop
+    and waits at most the returned delay before calling it again.
+    '''
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self.heap = []
+        self.cancelled = 0
+
+    def __len__(self):
+        return len(self.heap) - self.cancelled
+
+    def call_at(self, when, callback, *args):
+        '''
+        Schedules callback(*args) at the clock time when
+        '''
+        timer = Timer(when, callback, args, self)
+        heapq.heappush(self.heap, timer)
+        return timer
+
+    def call_later(self, delay, callback, *args):
+        '''
+        Schedules callback(*args) after delay seconds
+        '''
+        return self.call_at(self.clock() + delay, callback, *args)
+
+    def run_due(self):
+        '''
+        Runs every due timer.
+        Returns the seconds until the next timer, or None if there is none.
+        '''
+        while True:
+            timer, delay = self._pop_due()
+            if timer is None:
+                return delay
+            timer.callback(*timer.args)
+
+    def _pop_due(self):
+        # returns (due timer, None) or (None, seconds until the next timer or None)
+        heap = self.heap
+        while heap:
+            timer = heap[0]
+            if timer.cancelled:
+                heapq.heappop(heap)
+                self.cancelled -= 1
+                continue
+            delay = timer.when - self.clock()
+            if delay > 0:
+                return None, delay
+            heapq.heappop(heap)
+            # a fired timer no longer counts as cancelled in the heap
+            timer.scheduler = None
+            return timer, None
+        return None, None
+
+    def _cancel(self, timer):
+        if timer.cancelled:
+            return
+        timer.cancelled = True
+        if timer.scheduler is None:
+            # fired meanwhile, it is no longer in the heap
+            return
+        self.cancelled += 1
+        if self.cancelled > COMPACT_MIN and self.cancelled * 2 > len(self.heap):
+            self.heap = [timer for timer in self.heap if not timer.cancelled]
+            heapq.heapify(self.heap)
+            self.cancelled = 0
+
+
+class ThreadedScheduler(Scheduler):
+    '''
+    Scheduler shared by several threads. run() executes the callbacks on the calling thread,
+    without holding the scheduler lock, and is woken up when an earlier timer is added.
+    '''
+    def __init__(self, clock=time.monotonic):
+        super().__init__(clock)
+        self.condition = threading.Condition()
+        self.running = True
+
+    def call_at(self, when, callback, *args):
+        with self.condition:
+            timer = super().call_at(when, callback, *args)
+            if self.heap[0] is timer:
+                self.condition.notify()
+        return timer
+
+    def _cancel(self, timer):
+        # the flag and the count change together, _pop_due must not see one without the other
+        with self.condition:
+            super()._cancel(timer)
+
+    def run(self):
+        '''
+        Runs the timers until stop() is called
+        '''
+        while True:
+            with self.condition:
+                timer, delay = self._pop_due()
+                while timer is None:
+                    if not self.running:
+                        return
+                    self.condition.wait(delay)
+                    timer, delay = self._pop_due()
+            timer.callback(*timer.args)
+
+    def run_due(self):
+        while True:
+            with self.condition:
+                timer, delay = self._pop_due()
+            if timer is None:
+                return delay
+            timer.callback(*timer.args)
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify()
@@ -4,155 +4,670 @@ This module defines the behaviour of server in your Chat Application
 import sys
 import getopt
 import socket
+import asyncio
+import select
+import time
+import logging
+import binascii
+from collections import deque
 import util
+import batch_io
+import rtt
+import fragmentation
+import admission
+import ratelimit
+import scheduler
+import server_monitor
+import logs
+from logs import log
+from sessions import SessionRegistry
+
+# Constants for retransmission logic
+GIVE_UP_TIMEOUT = 10.0  # a client that acknowledges nothing for 10s is gone
+# packets held per client while waiting for a missing one
+MAX_REORDER = util.MAX_REORDER
+# with delayed ACKs, acknowledge at the latest every ACK_EVERY in-order packets
+ACK_EVERY = 2
+# a client silent for this long is gone, clients send a ping every client.KEEPALIVE_INTERVAL
+SESSION_TIMEOUT = 30.0
+
+class ServerProtocol(asyncio.DatagramProtocol):
+    '''
+    asyncio datagram protocol that hands every received packet to the Server.
+    '''
+    def __init__(self, server):
+        self.server = server
+
+    def connection_made(self, transport):
+        self.server.transport = transport
+
+    def datagram_received(self, data, addr):
+        self.server.process_packet(data, addr)
+
+    def error_received(self, exc):
+        log.warning("LOG: Soket hatası: %s", exc)
 
 
 class Server:
     '''
     This is the main Server Class. 
     '''
-    def __init__(self, dest, port, window):
+    def __init__(self, dest, port, window, engine="thread", cluster=None, ack_delay=0,
+                 max_clients=util.MAX_NUM_CLIENTS, packet_rate=ratelimit.PACKET_RATE,
+                 fanout_rate=ratelimit.FANOUT_RATE, metrics_port=0):
         self.server_addr = dest
         self.server_port = port
+        # packets in flight per client
+        self.window = max(1, int(window))
+        # seconds an ACK of in-order packets may wait for the next packets, 0 acknowledges every packet
+        # a longer delay would outlast the minimum RTO of the client and cause retransmissions
+        self.ack_delay = min(ack_delay, rtt.MAX_ACK_DELAY)
+        # hard limit of joined users, below it joins are refused only while the server is overloaded
+        self.max_clients = max_clients
+        self.admission = admission.AdmissionControl(self)
+        # packets and message recipients per second allowed to one client address
+        self.limiter = ratelimit.RateLimiter(packet_rate, fanout_rate)
+        self.monitor = server_monitor.ServerMonitor(self)
+        # local port of the Prometheus metrics endpoint, 0 for none
+        self.metrics_port = metrics_port
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if cluster is not None:
+            # every worker of the cluster binds the same port
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         self.sock.settimeout(None)
         self.sock.bind((self.server_addr, self.server_port))
-        self.clients = {}
-        self.client_info = {}
+        self.cluster = cluster
+        if cluster is not None:
+            self.sessions = cluster.make_registry(self)
+        else:
+            self.sessions = SessionRegistry()
+        self.engine = engine
+        self.transport = None
+        self.loop = None
+        # timers of the thread engine, the asyncio engine uses the event loop
+        self.timers = scheduler.Scheduler()
+        # packets queued while an engine is running, sent in bulk by flush()
+        self.outbox = []
+        # id of the last message sent in fragments
+        self.next_fid = 0
+        self.batching = False
+        self.sender = batch_io.BatchSender(self.sock)
 
     def start(self):
         '''
         Main loop.
         continue receiving messages from Clients and processing it
         '''
+        if self.engine == "asyncio":
+            self.start_async()
+            return
+        self.sock.setblocking(False)
+        receiver = batch_io.BatchReceiver(self.sock)
+        self.batching = True
+        self.admission.start()
+        if self.metrics_port:
+            self.monitor.serve(self.metrics_port)
         try:
             while True:
-                data, addr = self.sock.recvfrom(1024)
-                print(f"LOG: Ham paket alındı {addr}: {data}")
-                self.process_packet(data, addr)
+                timeout = self.timers.run_due()
+                self.flush()
+                if not select.select([self.sock], [], [], timeout)[0]:
+                    continue
+                # drain every datagram already queued on the socket
+                for data, addr in receiver.receive(wait=False):
+                    self.process_packet(data, addr)
+                self.flush()
+        except KeyboardInterrupt:
+            self.sock.close()
+        finally:
+            self.batching = False
+            self.admission.stop()
+            self.monitor.stop()
+
+    def start_async(self):
+        '''
+        Main loop of the asyncio engine.
+        Packets are received and dispatched by ServerProtocol, timers run on the same event loop.
+        '''
+        try:
+            asyncio.run(self._serve())
         except KeyboardInterrupt:
             self.sock.close()
-        
+
+    async def _serve(self):
+        self.loop = asyncio.get_running_loop()
+        self.sock.setblocking(False)
+        transport, _ = await self.loop.create_datagram_endpoint(
+            lambda: ServerProtocol(self), sock=self.sock)
+        if self.cluster is not None:
+            self.loop.add_reader(self.cluster.sock, self.cluster.receive)
+        self.batching = True
+        self.admission.start()
+        if self.metrics_port:
+            self.monitor.serve(self.metrics_port)
+        try:
+            await self.loop.create_future()
+        finally:
+            self.batching = False
+            self.admission.stop()
+            self.monitor.stop()
+            if self.cluster is not None:
+                self.loop.remove_reader(self.cluster.sock)
+            transport.close()
+            self.transport = None
+            self.loop = None
+
+    def call_later(self, delay, callback, *args):
+        '''
+        Schedules callback(*args) after delay seconds on the running engine.
+        Returns a handle with a cancel() method.
+        '''
+        if self.loop is not None:
+            return self.loop.call_later(delay, callback, *args)
+        return self.timers.call_later(delay, callback, *args)
+
+    def send_packet(self, packet, addr):
+        '''
+        Sends an encoded packet through the active engine.
+        While an engine runs the packet is queued and sent with the others by flush().
+        '''
+        self.monitor.packets_sent += 1
+        self.monitor.bytes_sent += len(packet)
+        if not self.batching:
+            self.sock.sendto(packet, addr)
+            return
+        if not self.outbox and self.loop is not None:
+            self.loop.call_soon(self.flush)
+        self.outbox.append((packet, addr))
+
+    def flush(self):
+        '''
+        Sends every queued packet, as few system calls as possible
+        '''
+        if not self.outbox:
+            return
+        started = time.perf_counter()
+        outbox, self.outbox = self.outbox, []
+        if self.transport is not None and self.transport.get_write_buffer_size():
+            # keep the order of the packets the transport already buffered
+            sent = 0
+        else:
+            sent = self.sender.send(outbox)
+        while sent < len(outbox):
+            if self.transport is not None:
+                for packet, addr in outbox[sent:]:
+                    self.transport.sendto(packet, addr)
+                break
+            select.select([], [self.sock], [], util.TIME_OUT)
+            sent += self.sender.send(outbox[sent:])
+        self.monitor.stage_seconds["flush"].observe(time.perf_counter() - started)
+
+    def queue_depth(self):
+        '''
+        Number of packets waiting to be sent, an estimate for the bytes buffered by the asyncio transport
+        '''
+        depth = len(self.outbox)
+        if self.transport is not None:
+            depth += -(-self.transport.get_write_buffer_size() // util.CHUNK_SIZE)
+        return depth
+
     def process_packet(self, data, addr):
+        # a flooding client is dropped before any parsing, its retransmissions back off
+        if not self.limiter.allow_packet(addr):
+            return
+        if log.isEnabledFor(logging.DEBUG):
+            # the received buffer is reused, the record keeps a copy
+            log.debug("LOG: Ham paket alındı %s: %s", addr, bytes(data))
+        monitor = self.monitor
+        started = parsed_at = time.perf_counter()
         try:
-            decoded_data = data.decode()
-            body, received_checksum = decoded_data.rsplit('|', 1)
-            body_with_pipe = body + '|'
-            
-            calculated_checksum = util.generate_checksum(body_with_pipe.encode())
-
-            if received_checksum != calculated_checksum:
-                print(f"LOG: Checksum uyuşmuyor, {addr} adresinden gelen paket yoksayıldı.")
+            parsed = util.parse_datagram(data)
+            parsed_at = time.perf_counter()
+            monitor.stage_seconds["parse"].observe(parsed_at - started)
+            if parsed is None:
+                monitor.checksum_failures += 1
+                log.warning("LOG: Checksum uyuşmuyor, %s adresinden gelen paket yoksayıldı.", addr)
                 return
-            
-            packet_type, seq_num_str, message, _ = util.parse_packet(decoded_data)
-            print(f"LOG: Paket çözümlendi: tip={packet_type}, sıra_no={seq_num_str}, mesaj='{message}'")
-            seq_num = int(seq_num_str)
+            packet_type, seq_num, payload, flags = parsed
+            if packet_type in monitor.received:
+                monitor.received[packet_type] += 1
+            else:
+                monitor.received["other"] += 1
+            monitor.bytes_received += len(data)
 
             # process the message
+            session = self.sessions.get(addr)
+            if session is not None:
+                session.last_seen = time.monotonic()
+            # out of order packets, duplicates and connection changes are acknowledged at once
+            ack_now = True
+            if packet_type == "ack":
+                log.debug("LOG: Paket çözümlendi: tip=%s, sıra_no=%d", packet_type, seq_num)
+                # acknowledgement of a packet sent by the server, it is not acknowledged back
+                if session is not None:
+                    # the client holds at most MAX_REORDER packets, only packets in flight can be listed
+                    sacked = util.parse_sack(str(payload, 'utf-8'), session.send_base,
+                                             min(session.send_seq, seq_num + MAX_REORDER)) if payload else ()
+                    self.handle_ack(session, seq_num, sacked)
+                return
+            if packet_type == "frag":
+                # fragments stay bytes, a chunk may end inside a multi-byte character
+                message = payload
+                log.debug("LOG: Paket çözümlendi: tip=%s, sıra_no=%d, %d bayt", packet_type, seq_num, len(payload))
+            else:
+                # only the payload is decoded, and only for packets carrying a message
+                message = str(payload, 'utf-8')
+                log.debug("LOG: Paket çözümlendi: tip=%s, sıra_no=%d, mesaj='%s'", packet_type, seq_num, message)
             if packet_type == "start":
-                self.client_info[addr] = seq_num
-                print(f"LOG: Bağlantı başlatıldı: {addr}.")
-            elif packet_type == "data":
-                if addr not in self.client_info:
-                    self.client_info[addr] = -1
+                if session is not None and seq_num <= session.recv_seq:
+                    # retransmitted start packet, it is only acknowledged again
+                    pass
+                else:
+                    session = self.open_session(addr)
+                    session.recv_seq = seq_num
+                    # the start packet lists the options of the client: acknowledgements, the binary format and compression
+                    options = message.split(',')
+                    session.reliable = util.RELIABLE_OPTION in options
+                    session.binary = util.BINARY_OPTION in options
+                    session.compress = session.binary and util.COMPRESSION_OPTION in options
+                    log.info("LOG: Bağlantı başlatıldı: %s.", addr, extra={"fields": {"event": "start", "addr": addr}})
+                    # packets that overtook the start packet
+                    self.release_reordered(session, addr)
+            elif packet_type in ("data", "frag"):
+                if session is None:
+                    session = self.open_session(addr)
 
-                expected_seq = self.client_info[addr] + 1
+                expected_seq = session.recv_seq + 1
                 if seq_num == expected_seq:
-                    self.client_info[addr] = seq_num
-                    
-                    message_parts = message.split()
-                    command = message_parts[0]
-
-                    if command == "join":
-                        username = message_parts[2]  
-                        self.join(username, addr)
-
-                    elif command == "request_users_list":
-                        if addr not in self.clients:
-                            print("Error: Address not recognized")
-                        else:
-                            self.request_users_list(self.clients[addr], addr)
-
-                    elif command == "send_message":
-                        try:
-                            num_recipients = int(message_parts[3])
-                            recipients = message_parts[4:4 + num_recipients]
-                            text = ' '.join(message_parts[4 + num_recipients:])
-                            sender_username = self.clients.get(addr, "Unknown")
-                            
-                            forward_message_content = f"{sender_username}: {text}"
-                            forward_message = util.make_message('msg', 4, forward_message_content)
-
-                            if len(recipients) == 1 and recipients[0] == 'all':
-                                print(f"LOG: msj: {sender_username} -> tümü")
-                                broadcast_list = [username for client_addr, username in self.clients.items() if client_addr != addr]
-                                self.send_message(sender_username, broadcast_list, forward_message)
-                            else:
-                                print(f"LOG: msj: {sender_username} -> {', '.join(recipients)}")
-                                self.send_message(sender_username, recipients, forward_message)
-                        except (IndexError, ValueError):
-                            pass
-
-                    elif command == "disconnect":
-                        try:
-                            username = message_parts[2]
-                            if addr in self.clients:
-                                del self.clients[addr]
-                                print(f"LOG: bağlantı kesildi: {username}")
-                            else:
-                                print(f"LOG: Var olmayan veya zaten bağlantısı kesilmiş kullanıcı tarafından bağlantı kesme denemesi: {username}")
-                        except IndexError:
-                            pass
-                    else:
-                        self.err_unknown_message(addr)
+                    # a packet filling a gap is acknowledged at once so the client learns about the gap quickly
+                    ack_now = bool(session.reorder)
+                    session.recv_seq = seq_num
+                    self.deliver(session, packet_type, message, flags, addr)
+                    self.release_reordered(session, addr)
+                elif expected_seq < seq_num <= session.recv_seq + MAX_REORDER:
+                    # arrived ahead of a missing packet, hold it until the gap fills
+                    if session.reorder is None:
+                        session.reorder = {}
+                    # the received payload lives in a buffer that is reused, keep a copy
+                    session.reorder[seq_num] = (packet_type, message if packet_type == "data" else bytes(message), flags)
+                    monitor.out_of_order += 1
+                    log.debug("LOG: %s adresinden sıra dışı paket tutuluyor. Beklenen: %d, gelen: %d", addr, expected_seq, seq_num)
                 else:
-                    print(f"LOG: {addr} adresinden beklenmeyen sıra numarası. Beklenen: {expected_seq}, gelen: {seq_num}")
+                    monitor.out_of_window += 1
+                    log.debug("LOG: %s adresinden beklenmeyen sıra numarası. Beklenen: %d, gelen: %d", addr, expected_seq, seq_num)
                 
+            elif packet_type == "ping":
+                # keepalive, answered with an ACK. Unknown addresses get no session.
+                pass
+
             elif packet_type == "end":
-                print(f"LOG: Bağlantı kapatıldı: {addr}.")
-                if addr in self.client_info:
-                    del self.client_info[addr]
+                log.info("LOG: Bağlantı kapatıldı: %s.", addr, extra={"fields": {"event": "end", "addr": addr}})
+                self.close_session(addr)
+                session = None
 
-            if addr in self.client_info:
-                ack_seq_num = self.client_info[addr] + 1
-                ack_packet = util.make_packet('ack', ack_seq_num, '')
-                print(f"LOG: Gelen pakete karşılık {addr} adresine ACK gönderildi: {ack_packet}")
-                self.sock.sendto(ack_packet.encode(), addr)
+            if session is not None:
+                if ack_now or not self.ack_delay:
+                    self.send_ack(session)
+                else:
+                    self.delay_ack(session)
 
         except ValueError:
-            print(f"LOG: {addr} adresinden gelen paket işlenirken hata: Hatalı biçimlendirilmiş paket")
+            monitor.malformed += 1
+            log.warning("LOG: %s adresinden gelen paket işlenirken hata: Hatalı biçimlendirilmiş paket", addr)
+        except Exception as e:
+            monitor.errors += 1
+            log.error("LOG: %s adresinden gelen paket işlenirken beklenmeyen bir hata oluştu: %s", addr, e, exc_info=True)
+        finally:
+            monitor.stage_seconds["process"].observe(time.perf_counter() - parsed_at)
+
+
+    def send_ack(self, session):
+        '''
+        Acknowledges every packet received in order from the client of session
+        '''
+        if session.ack_timer is not None:
+            session.ack_timer.cancel()
+            session.ack_timer = None
+        session.ack_pending = 0
+        self.monitor.acks_sent += 1
+        ack_seq_num = session.recv_seq + 1
+        # selective ACK: the ACK also lists the packets held in the reorder buffer
+        ack_packet = self.make_packet(session, 'ack', ack_seq_num, util.make_sack(session.reorder or ()).encode())
+        log.debug("LOG: Gelen pakete karşılık %s adresine ACK gönderildi: %s", session.addr, ack_packet)
+        self.send_packet(ack_packet, session.addr)
+
+    def delay_ack(self, session):
+        '''
+        Delayed ACK: one cumulative ACK covers ACK_EVERY in-order packets,
+        or the packets received within ack_delay seconds
+        '''
+        session.ack_pending += 1
+        if session.ack_pending >= ACK_EVERY:
+            self.send_ack(session)
+        elif session.ack_timer is None:
+            session.ack_timer = self.call_later(self.ack_delay, self.send_ack, session)
+
+    def release_reordered(self, session, addr):
+        '''
+        The gap is filled, processes the buffered packets that are now in order
+        and forgets the ones at or below recv_seq
+        '''
+        if not session.reorder:
+            return
+        while session.recv_seq + 1 in session.reorder:
+            session.recv_seq += 1
+            self.deliver(session, *session.reorder.pop(session.recv_seq), addr)
+        for stale in [seq for seq in session.reorder if seq <= session.recv_seq]:
+            del session.reorder[stale]
+
+    def deliver(self, session, packet_type, message, flags, addr):
+        '''
+        Processes a data or frag packet received in order. A message sent in fragments
+        is processed once its last fragment arrives.
+        A message that fails is skipped, the packets after it are still processed and acknowledged.
+        '''
+        try:
+            if packet_type == "frag":
+                if session.reassembly is None:
+                    session.reassembly = fragmentation.Reassembler()
+                payload = session.reassembly.add(message)
+                if payload is None:
+                    return
+                if flags & util.FLAG_ZLIB:
+                    payload = util.decompress_payload(payload)
+                message = str(payload, 'utf-8')
+            self.handle_command(session, message, addr)
+        except (ValueError, IndexError) as e:
+            self.monitor.malformed += 1
+            log.warning("LOG: %s adresinden gelen mesaj işlenemedi: %s", addr, e)
         except Exception as e:
-            print(f"LOG: {addr} adresinden gelen paket işlenirken beklenmeyen bir hata oluştu: {e}")
+            self.monitor.errors += 1
+            log.error("LOG: %s adresinden gelen mesaj işlenirken beklenmeyen bir hata oluştu: %s", addr, e, exc_info=True)
+
+    def handle_command(self, session, message, addr):
+        '''
+        Processes the message of a data packet received in order
+        '''
+        message_parts = message.split()
+        command = message_parts[0]
+
+        if command == "join":
+            username = message_parts[2]  
+            self.join(username, addr)
+
+        elif command == "request_users_list":
+            if session.username is None:
+                log.warning("Error: Address not recognized")
+            else:
+                self.request_users_list(session.username, addr)
+
+        elif command == "send_message":
+            try:
+                num_recipients = int(message_parts[3])
+                recipients = message_parts[4:4 + num_recipients]
+                text = ' '.join(message_parts[4 + num_recipients:])
+                sender_username = session.username or "Unknown"
+
+                forward_message_content = f"{sender_username}: {text}"
+                forward_message = util.make_message('msg', 4, forward_message_content)
 
+                if len(recipients) == 1 and recipients[0] == 'all':
+                    broadcast_list = [username for username, client_addr in self.sessions.users() if client_addr != addr]
+                    if self.cluster is not None:
+                        fanout = len(broadcast_list) + len(self.cluster.remote)
+                    else:
+                        fanout = len(broadcast_list)
+                    if self.throttle(session, fanout, addr):
+                        return
+                    log.debug("LOG: msj: %s -> tümü", sender_username)
+                    self.send_message(sender_username, broadcast_list, forward_message)
+                    if self.cluster is not None:
+                        self.cluster.broadcast(sender_username, forward_message)
+                else:
+                    if self.throttle(session, len(recipients), addr):
+                        return
+                    log.debug("LOG: msj: %s -> %s", sender_username, ', '.join(recipients))
+                    self.send_message(sender_username, recipients, forward_message)
+            except (IndexError, ValueError):
+                pass
+
+        elif command == "batch":
+            # commands coalesced by the client into one packet, processed in order
+            try:
+                commands = util.parse_batch(message.split(' ', 2)[2])
+            except (IndexError, ValueError):
+                self.err_unknown_message(addr)
+                return
+            log.debug("LOG: %s adresinden %d komutluk paket", addr, len(commands))
+            for item in commands:
+                if item.startswith("batch "):
+                    self.err_unknown_message(addr)
+                    return
+                self.handle_command(session, item, addr)
+
+        elif command == "disconnect":
+            try:
+                username = message_parts[2]
+                if self.sessions.unbind(session) is not None:
+                    log.info("LOG: bağlantı kesildi: %s", username, extra={"fields": {"event": "disconnect", "user": username}})
+                else:
+                    log.warning("LOG: Var olmayan veya zaten bağlantısı kesilmiş kullanıcı tarafından bağlantı kesme denemesi: %s", username)
+            except IndexError:
+                pass
+        else:
+            self.err_unknown_message(addr)
+
+    def make_packet(self, session, msg_type, seq_num, payload, payload_crc=None, flags=0):
+        '''
+        Builds a packet in the wire format negotiated with the client of session.
+        Only the binary format reuses payload_crc, the text checksum starts with the sequence number
+        so the payload is checksummed again for every recipient.
+        '''
+        if session.binary:
+            return util.make_binary_packet(msg_type, seq_num, payload, payload_crc, flags)
+        return util.make_packet_bytes(msg_type, seq_num, payload)
+
+    def encode_message(self, message, compress=False):
+        '''
+        Encodes a message sent to one or many clients, once.
+        Returns (packet type, payload, payload crc, flags) tuples, more than one if the message
+        does not fit one datagram and is sent in fragments. The message is compressed before
+        it is split, so compression also saves fragments.
+        '''
+        payload, flags = util.compress_payload(message.encode()) if compress else (message.encode(), 0)
+        if len(payload) <= fragmentation.MAX_CHUNK:
+            return [("data", payload, binascii.crc32(payload), flags)]
+        self.next_fid += 1
+        return [("frag", part, binascii.crc32(part), flags) for part in fragmentation.split(payload, self.next_fid)]
+
+    def send_parts(self, session, parts):
+        '''
+        Sends the packets of a message encoded by encode_message, returns the last one
+        '''
+        for msg_type, payload, payload_crc, flags in parts:
+            packet = self.send_reliable(session, payload, payload_crc, msg_type, flags)
+        return packet
+
+    def send_reliable(self, session, payload, payload_crc=None, msg_type="data", flags=0):
+        '''
+        Sends the encoded payload to the client of session as a data packet carrying the next
+        sequence number of the session, and keeps it for retransmission until it is acknowledged.
+        A client that did not ask for reliable delivery gets the packet once.
+        '''
+        seq_num = session.send_seq
+        session.send_seq += 1
+        packet = self.make_packet(session, msg_type, seq_num, payload, payload_crc, flags)
+        if not session.reliable:
+            self.send_packet(packet, session.addr)
+            return packet
+        if len(session.unacked) >= self.window or session.backlog:
+            # the send window of this client is full
+            if session.backlog is None:
+                session.backlog = deque()
+            session.backlog.append((seq_num, packet))
+            return packet
+        self.transmit(session, seq_num, packet)
+        return packet
+
+    def transmit(self, session, seq_num, packet):
+        '''
+        Sends a packet entering the send window and starts its retransmission timer
+        '''
+        if session.rtt is None:
+            session.rtt = rtt.RttEstimator()
+        now = time.monotonic()
+        timer = self.call_later(session.rtt.timeout(), self.retransmit, session, seq_num)
+        # packet, retransmission timer, retry_count, sent_time, first_sent_time
+        session.unacked[seq_num] = [packet, timer, 0, now, now]
+        self.send_packet(packet, session.addr)
+
+    def retransmit(self, session, seq_num):
+        '''
+        Retransmission timer of one packet. The timeout of the client doubles when its oldest packet times out,
+        the server gives up on the client when a packet stays unacknowledged for GIVE_UP_TIMEOUT
+        '''
+        entry = session.unacked.get(seq_num)
+        if entry is None:
+            return
+        now = time.monotonic()
+        if now - entry[4] >= GIVE_UP_TIMEOUT:
+            log.info("LOG: %s yanıt vermiyor, oturum kapatıldı.", session.addr, extra={"fields": {"event": "give_up", "addr": session.addr}})
+            self.close_session(session.addr)
+            return
+        if seq_num == session.send_base:
+            session.rtt.on_timeout()
+        entry[2] += 1
+        entry[3] = now
+        self.monitor.retransmissions += 1
+        entry[1] = self.call_later(session.rtt.timeout(), self.retransmit, session, seq_num)
+        log.debug("LOG: Zaman aşımı, %s adresine %d numaralı paket yeniden gönderiliyor (%d)", session.addr, seq_num, entry[2])
+        self.send_packet(entry[0], session.addr)
+
+    def handle_ack(self, session, ack_seq_num, sacked=()):
+        '''
+        ACKs are cumulative, ack_seq_num is the next sequence number the client expects
+        and sacked lists the packets the client holds out of order
+        '''
+        newest = session.unacked.get(ack_seq_num - 1)
+        if newest is not None and newest[2] == 0:
+            # Karn's rule: only packets sent once give an unambiguous RTT sample
+            session.rtt.sample(time.monotonic() - newest[3])
+        for seq_num in range(session.send_base, min(ack_seq_num, session.send_seq)):
+            entry = session.unacked.pop(seq_num, None)
+            if entry is not None:
+                entry[1].cancel()
+        if min(ack_seq_num, session.send_seq) > session.send_base:
+            session.send_base = min(ack_seq_num, session.send_seq)
+            session.rtt.progress()
+        # the newest transmission that arrived, packets sent before it were lost
+        delivered = 0
+        for seq_num in sacked:
+            entry = session.unacked.pop(seq_num, None)
+            if entry is not None:
+                entry[1].cancel()
+                if entry[2] == 0:
+                    delivered = max(delivered, entry[3])
+        if delivered:
+            self.fast_retransmit(session, delivered)
+        # the window slid, send what was waiting for it
+        while session.backlog and len(session.unacked) < self.window:
+            self.transmit(session, *session.backlog.popleft())
+
+    def fast_retransmit(self, session, delivered):
+        '''
+        Sends again at once the packets sent before delivered, the send time of a packet the client
+        received, instead of waiting for their timers. A packet is sent again once per ACK
+        showing that a later transmission overtook it.
+        '''
+        now = time.monotonic()
+        for seq_num, entry in list(session.unacked.items()):
+            if entry[3] < delivered:
+                entry[1].cancel()
+                entry[2] += 1
+                entry[3] = now
+                self.monitor.retransmissions += 1
+                entry[1] = self.call_later(session.rtt.timeout(), self.retransmit, session, seq_num)
+                log.debug("LOG: SACK, %s adresine %d numaralı paket hemen yeniden gönderiliyor (%d)", session.addr, seq_num, entry[2])
+                self.send_packet(entry[0], session.addr)
+
+    def open_session(self, addr):
+        '''
+        Returns the session of addr, creating it and its idle timer if needed
+        '''
+        session = self.sessions.get(addr)
+        if session is None:
+            session = self.sessions.open(addr)
+            session.last_seen = time.monotonic()
+            session.idle_timer = self.call_later(SESSION_TIMEOUT, self.check_idle, session)
+        return session
+
+    def check_idle(self, session):
+        '''
+        Idle timer of a session. Packets only update last_seen,
+        the timer is re-armed here for the remaining time so it costs nothing per packet.
+        '''
+        if self.sessions.get(session.addr) is not session:
+            return
+        idle = time.monotonic() - session.last_seen
+        if idle >= SESSION_TIMEOUT:
+            log.info("LOG: %s %.0f saniyedir sessiz, oturum kapatıldı.", session.addr, SESSION_TIMEOUT, extra={"fields": {"event": "idle", "addr": session.addr}})
+            self.close_session(session.addr)
+        else:
+            session.idle_timer = self.call_later(SESSION_TIMEOUT - idle, self.check_idle, session)
+
+    def close_session(self, addr):
+        '''
+        Forgets the client at addr and stops its retransmissions
+        '''
+        session = self.sessions.close(addr)
+        if session is not None:
+            for entry in session.unacked.values():
+                entry[1].cancel()
+            session.unacked.clear()
+            session.backlog = None
+            session.reorder = None
+            session.reassembly = None
+            if session.ack_timer is not None:
+                session.ack_timer.cancel()
+                session.ack_timer = None
+            if session.idle_timer is not None:
+                session.idle_timer.cancel()
+                session.idle_timer = None
+        return session
 
     def join(self, username, addr):
         '''
         This method is used to join the server
         '''
-        # check if server is full
-        if len(self.clients) >= util.MAX_NUM_CLIENTS:
+        # check if server is full, a max_clients of 0 sets no limit
+        session = self.open_session(addr)
+        if session.username is None and self.max_clients and self.sessions.user_count() >= self.max_clients:
             # send error message to the client
             error_message = util.make_message("ERR_SERVER_FULL", 2)
-            packet_to_send = util.make_packet("data", 0, error_message)
-            print(f"LOG: Gönderiliyor {addr}: {packet_to_send}")
-            self.sock.sendto(packet_to_send.encode(), addr)
+            packet_to_send = self.send_reliable(session, error_message.encode())
+            log.debug("LOG: Gönderiliyor %s: %s", addr, packet_to_send)
             # print disonnect message to server
-            print("disconnected: server full")
-        elif username in self.clients.values():
+            log.info("disconnected: server full", extra={"fields": {"event": "server_full", "addr": addr}})
+        elif session.username is None and self.admission.overloaded():
+            # overloaded, the client is told when to try again
+            retry_after = self.admission.retry_after()
+            busy_message = util.make_message("ERR_SERVER_BUSY", 1, "%.1f" % retry_after)
+            packet_to_send = self.send_reliable(session, busy_message.encode())
+            log.debug("LOG: Gönderiliyor %s: %s", addr, packet_to_send)
+            log.info("LOG: sunucu yoğun, %s %.1f saniye sonra tekrar deneyecek", username, retry_after,
+                     extra={"fields": {"event": "busy", "user": username, "retry_after": retry_after}})
+        elif not self.sessions.bind(session, username):
             # send error message to the client if username is already taken
             error_message = util.make_message("ERR_USERNAME_UNAVAILABLE", 2)
-            packet_to_send = util.make_packet("data", 0, error_message)
-            print(f"LOG: Gönderiliyor {addr}: {packet_to_send}")
-            self.sock.sendto(packet_to_send.encode(), addr)
+            packet_to_send = self.send_reliable(session, error_message.encode())
+            log.debug("LOG: Gönderiliyor %s: %s", addr, packet_to_send)
             # print disonnect message to server
-            print("disconnected: username not available")
+            log.info("disconnected: username not available", extra={"fields": {"event": "username_unavailable", "user": username}})
         else:
-            # add the client to the clients dictionary
-            self.clients[addr] = username
+            # the username is now bound to the client address
             # send successful join message to the client
-            print(f"join: {username}")
+            log.info("join: %s", username, extra={"fields": {"event": "join", "user": username, "addr": addr}})
 
     
     def request_users_list(self, username, addr):
@@ -160,49 +675,70 @@ class Server:
         This method is used to request the list of active users
         '''
         # get the list of users sorted A - Z
-        user_list = ', '.join(sorted(self.clients.values()))
+        user_list = ', '.join(sorted(self.sessions.usernames()))
         # send the list of users to the client
         response_msg = util.make_message("RESPONSE_USERS_LIST", 3, user_list)
-        response_packet = util.make_packet("data", 0, response_msg)
-        print(f"LOG: Gönderiliyor {addr}: {response_packet}")
-        self.sock.sendto(response_packet.encode(), addr)
+        session = self.open_session(addr)
+        response_packet = self.send_parts(session, self.encode_message(response_msg, session.compress))
+        log.debug("LOG: Gönderiliyor %s: %s", addr, response_packet)
         # print the request_users_list message to the server
-        print(f"request_users_list: {username}")
+        log.info("request_users_list: %s", username)
 
     
     def send_message(self, sender, active_users, message):
         '''
         This method is used to send a message to active users
         '''
+        self.monitor.fanout.observe(len(active_users))
+        # the message is the same for every recipient, encode it once per compression setting
+        encoded = {}
         # send the message to the active users
         for user in active_users:
-            # check if the user is in the clients dictionary
-            if user in self.clients.values():
-                # get the address of the recipient
-                recipient_address = [addr for addr, username in self.clients.items() if username == user]
-                # send the message to the recipient
-                for rec_addr in recipient_address:
-                    packet_to_send = util.make_packet("data", 0, message)
-                    print(f"LOG: Gönderiliyor {rec_addr}: {packet_to_send}")
-                    self.sock.sendto(packet_to_send.encode(), rec_addr)
+            # get the address of the recipient
+            rec_addr = self.sessions.lookup(user)
+            if rec_addr is not None:
+                # send the message to the recipient with its own sequence number
+                session = self.sessions.get(rec_addr)
+                parts = encoded.get(session.compress)
+                if parts is None:
+                    parts = encoded[session.compress] = self.encode_message(message, session.compress)
+                packet_to_send = self.send_parts(session, parts)
+                log.debug("LOG: Gönderiliyor %s: %s", rec_addr, packet_to_send)
+            elif self.cluster is not None and self.cluster.forward(sender, user, message):
+                # the recipient is connected to another worker
+                log.debug("LOG: msj: %s -> %s başka bir işçiye iletildi", sender, user)
             else:
                 # print the error message to the server
-                print(f"LOG: msj: {sender} -> var olmayan kullanıcı {user}")
+                log.info("LOG: msj: %s -> var olmayan kullanıcı %s", sender, user)
 
     
+    def throttle(self, session, recipients, addr):
+        '''
+        Charges a message to recipients users to the fan-out budget of addr.
+        Returns True if the message is over the limit, it is dropped and the client told when to retry.
+        '''
+        retry_after = self.limiter.allow_fanout(addr, recipients)
+        if not retry_after:
+            return False
+        self.monitor.throttled += 1
+        throttle_message = util.make_message("ERR_THROTTLED", 1, "%.2f" % retry_after)
+        packet_to_send = self.send_reliable(session, throttle_message.encode())
+        log.debug("LOG: Gönderiliyor %s: %s", addr, packet_to_send)
+        log.info("LOG: %s mesaj sınırını aştı, %d alıcılı mesaj atıldı", session.username, recipients,
+                 extra={"fields": {"event": "throttled", "user": session.username, "recipients": recipients}})
+        return True
+
     def err_unknown_message(self, addr):
         '''
         This method is used to handle errors
         '''
         error_message = util.make_message("ERR_UNKNOWN_MESSAGE", 2)
-        packet_to_send = util.make_packet("data", 0, error_message)
-        print(f"LOG: Gönderiliyor {addr}: {packet_to_send}")
-        self.sock.sendto(packet_to_send.encode(), addr)
-        if addr in self.clients:
-            # delete the client from the clients dictionary
-            del self.clients[addr]
+        session = self.open_session(addr)
+        packet_to_send = self.send_reliable(session, error_message.encode())
+        log.debug("LOG: Gönderiliyor %s: %s", addr, packet_to_send)
+        if self.sessions.unbind(session) is not None:
             # print the disconnect message to the server
-            print("disconnected: server received an unknown message")
+            log.info("disconnected: server received an unknown message", extra={"fields": {"event": "unknown_message", "addr": addr}})
 
 
 if __name__ == "__main__":
@@ -214,11 +750,22 @@ if __name__ == "__main__":
         print("-p PORT | --port=PORT The server port, defaults to 15000")
         print("-a ADDRESS | --address=ADDRESS The server ip or hostname, defaults to localhost")
         print("-w WINDOW | --window=WINDOW The window size, default is 3")
+        print("-e ENGINE | --engine=ENGINE The server engine, thread or asyncio, defaults to thread")
+        print("-n WORKERS | --workers=WORKERS Number of worker processes sharing the port, defaults to 1")
+        print("-c MAX_CLIENTS | --max-clients=MAX_CLIENTS Maximum number of joined users, defaults to 0 (no limit, joins wait while the server is overloaded)")
+        print("-d DELAY_MS | --ack-delay=DELAY_MS Delay ACKs of in-order packets up to DELAY_MS, at most %d, defaults to 0 (off)" % (rtt.MAX_ACK_DELAY * 1000))
+        print("-r PACKETS | --packet-rate=PACKETS Packets per second accepted from one client, defaults to %d, 0 is unlimited" % ratelimit.PACKET_RATE)
+        print("-f RECIPIENTS | --fanout-rate=RECIPIENTS Message recipients per second of one client, defaults to %d, 0 is unlimited" % ratelimit.FANOUT_RATE)
+        print("-m PORT | --metrics-port=PORT Serve Prometheus metrics on http://localhost:PORT/metrics, workers use PORT + worker number")
+        print("-l LEVEL | --log-level=LEVEL debug, info, warning or error, defaults to info. debug traces every packet")
+        print("-j FILE | --log-json=FILE Also write the log to FILE as JSON lines")
         print("-h | --help Print this help")
 
     try:
         OPTS, ARGS = getopt.getopt(sys.argv[1:],
-                                   "p:a:w", ["port=", "address=","window="])
+                                   "p:a:w:e:n:d:c:r:f:l:j:m:", ["port=", "address=","window=", "engine=", "workers=", "ack-delay=",
+                                                                 "max-clients=", "packet-rate=", "fanout-rate=",
+                                                                 "log-level=", "log-json=", "metrics-port="])
     except getopt.GetoptError:
         helper()
         exit()
@@ -226,16 +773,61 @@ if __name__ == "__main__":
     PORT = 15000
     DEST = "localhost"
     WINDOW = 3
+    ENGINE = "thread"
+    WORKERS = 1
+    ACK_DELAY = 0
+    MAX_CLIENTS = util.MAX_NUM_CLIENTS
+    PACKET_RATE = ratelimit.PACKET_RATE
+    FANOUT_RATE = ratelimit.FANOUT_RATE
+    LOG_LEVEL = logging.INFO
+    LOG_JSON = None
+    METRICS_PORT = 0
 
     for o, a in OPTS:
         if o in ("-p", "--port="):
             PORT = int(a)
         elif o in ("-a", "--address="):
             DEST = a
-        elif o in ("-w", "--window="):
-            WINDOW = a
+        elif o in ("-w", "--window"):
+            WINDOW = int(a)
+        elif o in ("-e", "--engine"):
+            if a not in ("thread", "asyncio"):
+                helper()
+                exit()
+            ENGINE = a
+        elif o in ("-n", "--workers"):
+            WORKERS = int(a)
+        elif o in ("-d", "--ack-delay"):
+            ACK_DELAY = int(a) / 1000
+            if not 0 <= ACK_DELAY <= rtt.MAX_ACK_DELAY:
+                helper()
+                exit()
+        elif o in ("-c", "--max-clients"):
+            MAX_CLIENTS = int(a)
+        elif o in ("-r", "--packet-rate"):
+            PACKET_RATE = int(a)
+        elif o in ("-f", "--fanout-rate"):
+            FANOUT_RATE = int(a)
+        elif o in ("-l", "--log-level"):
+            if a not in logs.LEVELS:
+                helper()
+                exit()
+            LOG_LEVEL = logs.LEVELS[a]
+        elif o in ("-j", "--log-json"):
+            LOG_JSON = a
+        elif o in ("-m", "--metrics-port"):
+            METRICS_PORT = int(a)
+
+    if WORKERS > 1:
+        # the workers run the asyncio engine, it multiplexes the client and cluster sockets
+        import cluster
+        cluster.run_workers(WORKERS, DEST, PORT, WINDOW, ACK_DELAY, MAX_CLIENTS, PACKET_RATE, FANOUT_RATE,
+                            LOG_LEVEL, LOG_JSON, METRICS_PORT)
+        exit()
 
-    SERVER = Server(DEST, PORT,WINDOW)
+    logs.setup(LOG_LEVEL, LOG_JSON)
+    SERVER = Server(DEST, PORT, WINDOW, ENGINE, ack_delay=ACK_DELAY, max_clients=MAX_CLIENTS,
+                    packet_rate=PACKET_RATE, fanout_rate=FANOUT_RATE, metrics_port=METRICS_PORT)
     try:
         SERVER.start()
     except (KeyboardInterrupt, SystemExit):
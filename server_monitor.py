@@ -0,0 +1,160 @@
+'''
+Performance monitor of the server, the counterpart of the client's PerformanceMonitor.
+The packet loop only increments counters and histogram buckets, no lock and no I/O.
+The numbers are served in the Prometheus text format on a local HTTP port, read by a
+separate thread at scrape time.
+'''
+import time
+import bisect
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import util
+
+# upper bounds of the histogram buckets
+STAGE_BUCKETS = (5e-6, 1e-5, 2.5e-5, 5e-5, 1e-4, 2.5e-4, 5e-4, 1e-3, 2.5e-3, 5e-3, 1e-2, 2.5e-2, 5e-2, 0.1)
+FANOUT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+STAGES = ("parse", "process", "flush")
+
+
+class Histogram:
+    '''
+    Counts of observations per bucket, bucket i holds the values up to bounds[i]
+    and the last bucket everything above
+    '''
+    __slots__ = ('bounds', 'counts', 'sum', 'count')
+
+    def __init__(self, bounds):
+        self.bounds = tuple(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self, name, labels=""):
+        '''
+        Lines of the histogram in the Prometheus text format, with cumulative buckets
+        '''
+        separator = "," if labels else ""
+        counts = list(self.counts)
+        lines = []
+        total = 0
+        for bound, count in zip(self.bounds, counts):
+            total += count
+            lines.append('%s_bucket{%s%sle="%g"} %d' % (name, labels, separator, bound, total))
+        total += counts[-1]
+        lines.append('%s_bucket{%s%sle="+Inf"} %d' % (name, labels, separator, total))
+        braces = "{%s}" % labels if labels else ""
+        lines.append("%s_sum%s %r" % (name, braces, self.sum))
+        lines.append("%s_count%s %d" % (name, braces, total))
+        return lines
+
+
+class ServerMonitor:
+    '''
+    Counters and histograms of one server.
+    The attributes are updated by the server while it handles packets.
+    '''
+    def __init__(self, server):
+        self.server = server
+        self.started = time.time()
+        # packets of a type the server does not know are counted as other
+        self.received = dict.fromkeys(util.PACKET_TYPES + ("other",), 0)
+        self.bytes_received = 0
+        self.packets_sent = 0
+        self.bytes_sent = 0
+        self.acks_sent = 0
+        self.checksum_failures = 0
+        # packets or messages with a valid checksum whose content could not be processed
+        self.malformed = 0
+        # packets ahead of a gap held in the reorder buffer, and packets outside the window dropped
+        self.out_of_order = 0
+        self.out_of_window = 0
+        self.retransmissions = 0
+        self.throttled = 0
+        self.errors = 0
+        self.stage_seconds = {stage: Histogram(STAGE_BUCKETS) for stage in STAGES}
+        self.fanout = Histogram(FANOUT_BUCKETS)
+        self.httpd = None
+
+    def serve(self, port, host="127.0.0.1"):
+        '''
+        Starts the metrics endpoint, GET /metrics on host:port
+        '''
+        monitor = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = monitor.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                # scrapes are not logged
+                pass
+
+        self.httpd = ThreadingHTTPServer((host, port), MetricsHandler)
+        self.httpd.daemon_threads = True
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def stop(self):
+        if self.httpd is not None:
+            self.httpd.shutdown()
+            self.httpd.server_close()
+            self.httpd = None
+
+    def render(self):
+        '''
+        All metrics in the Prometheus text format
+        '''
+        server = self.server
+        lines = []
+
+        def metric(name, kind, text, samples):
+            lines.append("# HELP %s %s" % (name, text))
+            lines.append("# TYPE %s %s" % (name, kind))
+            for labels, value in samples:
+                lines.append("%s%s %s" % (name, "{%s}" % labels if labels else "", value))
+
+        metric("chat_uptime_seconds", "gauge", "Seconds since the server started", [("", "%.3f" % (time.time() - self.started))])
+        metric("chat_packets_received_total", "counter", "Packets received, by type",
+               [('type="%s"' % packet_type, count) for packet_type, count in list(self.received.items())])
+        metric("chat_bytes_received_total", "counter", "Bytes of the packets received", [("", self.bytes_received)])
+        metric("chat_packets_sent_total", "counter", "Packets sent", [("", self.packets_sent)])
+        metric("chat_bytes_sent_total", "counter", "Bytes of the packets sent", [("", self.bytes_sent)])
+        metric("chat_acks_sent_total", "counter", "ACKs sent", [("", self.acks_sent)])
+        metric("chat_checksum_failures_total", "counter", "Packets dropped for a bad checksum or header",
+               [("", self.checksum_failures)])
+        metric("chat_malformed_total", "counter", "Packets or messages dropped because their content could not be processed",
+               [("", self.malformed)])
+        metric("chat_out_of_sequence_total", "counter", "Packets not received in order",
+               [('action="buffered"', self.out_of_order), ('action="dropped"', self.out_of_window)])
+        metric("chat_retransmissions_total", "counter", "Packets sent again after a timeout or a selective ACK", [("", self.retransmissions)])
+        metric("chat_rate_limited_packets_total", "counter", "Packets dropped by the per-client rate limit",
+               [("", server.limiter.dropped)])
+        metric("chat_throttled_messages_total", "counter", "Messages dropped by the per-client fan-out limit",
+               [("", self.throttled)])
+        metric("chat_errors_total", "counter", "Packets that raised an unexpected error", [("", self.errors)])
+        metric("chat_sessions", "gauge", "Open sessions", [("", len(server.sessions))])
+        metric("chat_users", "gauge", "Joined users", [("", server.sessions.user_count())])
+        metric("chat_send_queue_depth", "gauge", "Packets waiting to be sent", [("", server.queue_depth())])
+        metric("chat_loop_lag_seconds", "gauge", "Smoothed lateness of the engine timers", [("", "%.6f" % server.admission.lag)])
+        metric("chat_cpu_ratio", "gauge", "Smoothed share of one core used by the process", [("", "%.3f" % server.admission.cpu)])
+
+        lines.append("# HELP chat_stage_seconds Processing time per packet and per flush, by stage")
+        lines.append("# TYPE chat_stage_seconds histogram")
+        for stage, histogram in self.stage_seconds.items():
+            lines.extend(histogram.render("chat_stage_seconds", 'stage="%s"' % stage))
+        lines.append("# HELP chat_fanout_recipients Recipients of a forwarded message")
+        lines.append("# TYPE chat_fanout_recipients histogram")
+        lines.extend(self.fanout.render("chat_fanout_recipients"))
+        return "\n".join(lines) + "\n"
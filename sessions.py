@@ -0,0 +1,135 @@
+'''
+This module keeps the per-client state of the server.
+Sessions are indexed both by address and by username so routing a message is a dictionary lookup.
+'''
+
+
+class Session:
+    '''
+    State the server keeps for one client address
+    '''
+    __slots__ = ('addr', 'username', 'recv_seq', 'send_seq', 'send_base', 'unacked', 'backlog', 'reorder', 'rtt',
+                 'reliable', 'binary', 'compress', 'reassembly', 'ack_pending', 'ack_timer',
+                 'last_seen', 'idle_timer')
+
+    def __init__(self, addr):
+        self.addr = addr
+        self.username = None
+        # last in-order sequence number received from this client
+        self.recv_seq = -1
+        # seq_num -> message of packets received ahead of recv_seq + 1, created on first use
+        self.reorder = None
+        # in-order packets not acknowledged yet and the timer of the delayed ACK
+        self.ack_pending = 0
+        self.ack_timer = None
+        # time.monotonic() of the last packet from this client and the timer expiring the session
+        self.last_seen = 0.0
+        self.idle_timer = None
+        # Reassembler of the messages this client sends in fragments, created on first use
+        self.reassembly = None
+        # next sequence number the server sends to this client
+        self.send_seq = 0
+        # oldest sequence number not yet acknowledged by this client
+        self.send_base = 0
+        # seq_num -> [packet, retransmission timer, retry_count, sent_time, first_sent_time]
+        self.unacked = {}
+        # (seq_num, packet) waiting for room in the send window, created on first use
+        self.backlog = None
+        # RttEstimator of this client, created with the first packet sent to it
+        self.rtt = None
+        # the client acknowledges packets sent to it, negotiated by the start packet
+        self.reliable = False
+        # packets to this client use the binary wire format, negotiated by the start packet
+        self.binary = False
+        # large payloads to this client are compressed, binary format only
+        self.compress = False
+
+
+class SessionRegistry:
+    '''
+    Bidirectional registry: address -> Session and username -> address.
+    Every change of a username goes through bind/unbind/close so both indexes stay consistent.
+    '''
+    def __init__(self):
+        self.by_addr = {}
+        self.by_name = {}
+
+    def __len__(self):
+        return len(self.by_addr)
+
+    def __contains__(self, addr):
+        return addr in self.by_addr
+
+    def get(self, addr):
+        '''
+        Returns the session of addr or None
+        '''
+        return self.by_addr.get(addr)
+
+    def open(self, addr):
+        '''
+        Returns the session of addr, creating it if needed
+        '''
+        session = self.by_addr.get(addr)
+        if session is None:
+            session = self.by_addr[addr] = Session(addr)
+        return session
+
+    def close(self, addr):
+        '''
+        Removes the session of addr and releases its username
+        '''
+        session = self.by_addr.pop(addr, None)
+        if session is not None:
+            self.unbind(session)
+        return session
+
+    def bind(self, session, username):
+        '''
+        Attaches username to session. Returns False if another session holds it.
+        '''
+        owner = self.by_name.get(username)
+        if owner is not None and owner != session.addr:
+            return False
+        if session.username is not None and session.username != username:
+            self.unbind(session)
+        session.username = username
+        self.by_name[username] = session.addr
+        return True
+
+    def unbind(self, session):
+        '''
+        Detaches the username of session, returns the released username or None
+        '''
+        username = session.username
+        if username is None:
+            return None
+        session.username = None
+        if self.by_name.get(username) == session.addr:
+            del self.by_name[username]
+        return username
+
+    def lookup(self, username):
+        '''
+        Returns the address of username or None
+        '''
+        return self.by_name.get(username)
+
+    def username_of(self, addr):
+        '''
+        Returns the username joined from addr or None
+        '''
+        session = self.by_addr.get(addr)
+        return session.username if session is not None else None
+
+    def user_count(self):
+        return len(self.by_name)
+
+    def usernames(self):
+        return self.by_name.keys()
+
+    def users(self):
+        '''
+        Iterates over (username, address) pairs of the joined users
+        '''
+        return self.by_name.items()
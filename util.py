@@ -2,11 +2,37 @@
 This file contains basic utility functions that you can use and can also make your helper functions here
 '''
 import binascii
+import struct
+import zlib
 
-MAX_NUM_CLIENTS = 10
+# no hard cap on joined users by default, joins are refused while the server is overloaded
+MAX_NUM_CLIENTS = 0
 TIME_OUT = 0.5 # 500ms
 CHUNK_SIZE = 1400 # 1400 Bytes
 
+# Reliable delivery from the server, used towards clients that sent RELIABLE_OPTION in their start packet.
+# Other clients, like those of the first version of the protocol, never acknowledge and get every packet once.
+RELIABLE_OPTION = "ack"
+# Binary wire format, used when the client asks for it with a start packet carrying BINARY_OPTION.
+# The first byte of a text packet is a letter, BINARY_MAGIC tells the formats apart.
+BINARY_OPTION = "bin"
+BINARY_MAGIC = 0xC5
+BINARY_VERSION = 1
+# magic, version, type, flags, sequence number, payload length; followed by the CRC32 and the payload
+BINARY_HEADER = struct.Struct("!BBBBII")
+BINARY_CRC = struct.Struct("!I")
+BINARY_HEADER_SIZE = BINARY_HEADER.size + BINARY_CRC.size
+PACKET_TYPES = ("start", "data", "ack", "end", "frag", "ping")
+PACKET_TYPE_CODES = {msg_type: code for code, msg_type in enumerate(PACKET_TYPES)}
+# Compression of binary payloads, used towards peers that sent COMPRESSION_OPTION in their start packet.
+# FLAG_ZLIB marks a compressed payload; on frag packets it marks the reassembled message.
+COMPRESSION_OPTION = "zlib"
+FLAG_ZLIB = 0x01
+COMPRESS_THRESHOLD = 256
+MAX_DECOMPRESSED_SIZE = 1 << 20
+# packets a receiver holds ahead of a missing one, a selective ACK lists none further
+MAX_REORDER = 64
+
 def validate_checksum(message):
     '''
     Validates Checksum of a message and returns true/false
@@ -30,7 +56,7 @@ def make_packet(msg_type="data", seqno=0, msg=""):
     '''
     This will add the header to your message.
     The formats is `<message_type> <sequence_number> <body> <checksum>`
-    msg_type can be data, ack, end, start
+    msg_type can be data, ack, end, start, frag, ping
     seqno is a packet sequence number (integer)
     msg is the actual message string
     '''
@@ -40,6 +66,177 @@ def make_packet(msg_type="data", seqno=0, msg=""):
     return packet
 
 
+def make_packet_bytes(msg_type="data", seqno=0, payload=b""):
+    '''
+    Builds the same packet as make_packet(msg_type, seqno, msg).encode()
+    from the already encoded message, so a message sent to many recipients is encoded only once.
+    '''
+    body = b"%s|%d|%s|" % (msg_type.encode(), seqno, payload)
+    return body + generate_checksum(body).encode()
+
+
+def make_binary_packet(msg_type="data", seqno=0, payload=b"", payload_crc=None, flags=0):
+    '''
+    Binary counterpart of make_packet_bytes: a BINARY_HEADER, the CRC32 and the raw payload.
+    The CRC covers the payload first and then the header, so the CRC of a payload sent to many
+    recipients is computed once (payload_crc) and only the header is checksummed per packet.
+    '''
+    if payload_crc is None:
+        payload_crc = binascii.crc32(payload)
+    header = BINARY_HEADER.pack(BINARY_MAGIC, BINARY_VERSION, PACKET_TYPE_CODES[msg_type], flags, seqno, len(payload))
+    return b"".join((header, BINARY_CRC.pack(binascii.crc32(header, payload_crc)), payload))
+
+
+def compress_payload(payload):
+    '''
+    Compresses a payload worth compressing. Returns (payload, flags) to pass to make_binary_packet.
+    '''
+    if len(payload) >= COMPRESS_THRESHOLD:
+        compressed = zlib.compress(payload)
+        if len(compressed) < len(payload):
+            return compressed, FLAG_ZLIB
+    return payload, 0
+
+
+def decompress_payload(payload):
+    '''
+    Reverses compress_payload, raises ValueError for a corrupted or oversized payload
+    '''
+    decompressor = zlib.decompressobj()
+    try:
+        data = decompressor.decompress(payload, MAX_DECOMPRESSED_SIZE)
+    except zlib.error as e:
+        raise ValueError(str(e))
+    if decompressor.unconsumed_tail or not decompressor.eof:
+        raise ValueError("compressed payload too large or truncated")
+    return data
+
+
+def is_binary_packet(data):
+    '''
+    Tells a binary packet from a text one by its first byte
+    '''
+    return len(data) > 0 and data[0] == BINARY_MAGIC
+
+
+def parse_binary_packet(data):
+    '''
+    Validates and parses a binary packet in one pass, the payload is a memoryview into data.
+    A compressed payload is decompressed, except for fragments which are decompressed once reassembled.
+    Returns (msg_type, seqno, payload, flags) or None if the packet is corrupted.
+    '''
+    view = memoryview(data)
+    if len(view) < BINARY_HEADER_SIZE:
+        return None
+    magic, version, type_code, flags, seqno, length = BINARY_HEADER.unpack_from(view)
+    if (magic != BINARY_MAGIC or version != BINARY_VERSION or type_code >= len(PACKET_TYPES)
+            or length != len(view) - BINARY_HEADER_SIZE):
+        return None
+    payload = view[BINARY_HEADER_SIZE:]
+    checksum = binascii.crc32(view[:BINARY_HEADER.size], binascii.crc32(payload))
+    if checksum != BINARY_CRC.unpack_from(view, BINARY_HEADER.size)[0]:
+        return None
+    msg_type = PACKET_TYPES[type_code]
+    if flags & FLAG_ZLIB and msg_type != "frag":
+        try:
+            payload = decompress_payload(payload)
+        except ValueError:
+            return None
+        flags &= ~FLAG_ZLIB
+    return msg_type, seqno, payload, flags
+
+
+def parse_text_packet(data):
+    '''
+    Validates and parses a text packet straight from the received bytes, in one pass and without
+    decoding or copying the payload. The payload is a memoryview into data.
+    Returns (msg_type, seqno, payload, flags) like parse_binary_packet, or None if the packet is corrupted.
+    '''
+    view = memoryview(data)
+    # the checksum is the last field and has at most 10 digits
+    tail_start = max(len(view) - 11, 0)
+    tail = bytes(view[tail_start:])
+    cut = tail.rfind(b'|')
+    if cut < 0:
+        return None
+    end = tail_start + cut
+    # the type and the sequence number are short, only the start of the packet is searched
+    head = bytes(view[:min(end, 32)])
+    first = head.find(b'|')
+    second = head.find(b'|', first + 1)
+    if first < 0 or second < 0:
+        return None
+    if b"%d" % binascii.crc32(view[:end + 1]) != tail[cut + 1:]:
+        return None
+    try:
+        msg_type = head[:first].decode('ascii')
+        seqno = int(head[first + 1:second])
+    except ValueError:
+        return None
+    return msg_type, seqno, view[second + 1:end], 0
+
+
+def parse_datagram(data):
+    '''
+    Validates and parses a received packet of either wire format.
+    Returns (msg_type, seqno, payload, flags) or None if the packet is corrupted.
+    '''
+    if is_binary_packet(data):
+        return parse_binary_packet(data)
+    return parse_text_packet(data)
+
+
+def make_sack(seqnos):
+    '''
+    Formats the sequence numbers a receiver holds out of order as ranges, e.g. "5-7,9"
+    '''
+    ranges = []
+    for seqno in sorted(seqnos):
+        if ranges and ranges[-1][1] == seqno - 1:
+            ranges[-1][1] = seqno
+        else:
+            ranges.append([seqno, seqno])
+    return ','.join(str(a) if a == b else "%d-%d" % (a, b) for a, b in ranges)
+
+
+def parse_sack(sack, lowest, highest):
+    '''
+    Returns the set of sequence numbers listed by make_sack from lowest up to highest (excluded).
+    Every range is clamped before it is expanded, a peer cannot make the set larger than highest - lowest.
+    '''
+    seqnos = set()
+    for block in sack.split(','):
+        if not block:
+            continue
+        first, _, last = block.partition('-')
+        seqnos.update(range(max(int(first), lowest), min(int(last or first) + 1, highest)))
+    return seqnos
+
+
+def make_batch(commands):
+    '''
+    Packs several commands into the body of one batch message,
+    every command is prefixed with its length: "<length> <command>"
+    '''
+    return "".join("%d %s" % (len(command), command) for command in commands)
+
+
+def parse_batch(body):
+    '''
+    Returns the commands packed by make_batch
+    '''
+    commands = []
+    pos = 0
+    while pos < len(body):
+        space = body.index(' ', pos)
+        end = space + 1 + int(body[pos:space])
+        if end > len(body):
+            raise ValueError("truncated batch")
+        commands.append(body[space + 1:end])
+        pos = end
+    return commands
+
+
 def parse_packet(message):
     '''
     This function will parse the packet in the same way it was made in the above function.